@@ -0,0 +1,355 @@
+'''
+Benchmarks for G-SHE's screen, font, and text hot paths, run on an
+offscreen screen buffer so that no display is needed. Each result is
+compared with a stored baseline, and any whose rate has dropped by more
+than the tolerance is flagged as a regression.
+'''
+
+import os, os.path
+import pickle
+import random
+import runpy
+import shutil
+import sys
+import tempfile
+import zlib
+
+os.environ.setdefault('SDL_VIDEODRIVER', 'dummy')
+import sdl2
+
+import document
+import hexedit
+import scrbuf
+
+
+BASELINESIG = 'G-SHE benchmark baseline 1'
+basepath = os.path.dirname(os.path.abspath(__file__))
+sampletext = u'Here is a very long run of text, with some short words, ' \
+             u'and some very long words like extraordinary, Mississippi, ' \
+             u'and canteloupe. Caf\xe9s serve cr\xe8me br\xfbl\xe9e\u2026 ' \
+             u'\xa92018 \u2190 lactose-intolerant \u2192 Put-In-Bay, ' \
+             u'merry-go-round, state-of-the-art, and ground-breaking. '
+
+
+class Quiet(object):
+    #swallow the chatter printed by hexedit and packfont while timing
+    def __enter__(self):
+        self.stdout = sys.stdout
+        sys.stdout = open(os.devnull, 'w')
+
+    def __exit__(self, *args):
+        sys.stdout.close()
+        sys.stdout = self.stdout
+
+
+def cases(tempdir):
+    #return [(name, setup, op)] for every benchmark, where setup (or None)
+    #is run untimed before each timed call of op
+    screen = hexedit.screen
+    results = []
+    def add(name, op, setup=None):
+        results.append((name, setup, op))
+    #screen buffer
+    rand = random.Random(1912)
+    fill = ''.join(chr(rand.randrange(32, 127)) for i in xrange(2000))
+    attrs = [rand.choice(hexedit.cellcolors.keys()) for i in xrange(2000)]
+    screen.cbuf[ : , : ] = fill
+    screen.abuf[ : , : ] = attrs
+    screen.refresh()
+    area = (slice(10, 50), slice(5, 15))
+    add('refresh.full', screen.refresh, screen.invalidate)
+    add('refresh.partial', lambda: screen.refresh(area),
+        lambda: screen.invalidate(area))
+    add('refresh.unchanged', screen.refresh)
+    def newline():
+        screen.cbuf[ : , screen.NROWS - 1] = fill[: 80]
+    add('scroll', lambda: screen.scroll(1), newline)
+    longtext = '\n'.join(fill[i : i + 300] for i in xrange(0, 2000, 300))
+    add('printText', lambda: screen.printText(longtext),
+        lambda: screen.cursorTo((0, 0)))
+    block = fill[: 60 * 17]
+    add('bytebuf.get', lambda: screen.cbuf[10 : 70, 3 : 20])
+    def bytebufset():
+        screen.cbuf[10 : 70, 3 : 20] = block
+    add('bytebuf.set', bytebufset)
+    #text encoding, with the extension set tables of the default font
+    rootdict, basesets, extsets, gpages = readfont(
+        hexedit.prefs['font.file'])
+    for k in ('437', '1252'):
+        if k in extsets:
+            table = [unichr(c) for c in extsets[k][0][3]]
+            add('altencode.' + k,
+                lambda table=table: hexedit.altencode(sampletext, table),
+                hexedit.encodecache.clear)
+    del rootdict, basesets, extsets, gpages
+    #word wrap, with the layout caches emptied before each call
+    def forgetlayouts():
+        hexedit.layoutcache.clear()
+        hexedit.layoutstates.clear()
+    for n in (60, 300, 1200):
+        text = (sampletext * (n // len(sampletext) + 1))[: n]
+        for w, h in ((20, 5), (56, 15), (78, 23)):
+            add('wraptext.{:d}.{:d}x{:d}'.format(n, w, h),
+                lambda text=text, w=w, h=h:
+                    hexedit.wraptext(text, (1, 1 + w), (1, 1 + h),
+                                     hexedit.ALIGN_LEFT),
+                forgetlayouts)
+    #documents, showing a random window of a sparse 1 GiB file, and
+    #editing another view of it
+    docname = os.path.join(tempdir, 'sparse.bin')
+    with open(docname, 'wb') as f:
+        f.seek((1 << 30) - 1)
+        f.write('\x00')
+    doc = document.Document(docname)
+    add('document.view',
+        lambda: hexedit.drawdocument(doc, rand.randrange(doc.size) & ~15))
+    #formatting a screen of hex view rows, without drawing it
+    rowdata = fill[: 32 * (screen.NROWS - 1)]
+    table = hexedit.texttable(screen.encoding)
+    for n in (8, 16, 32):
+        layout = hexedit.RowLayout(n, 8)
+        add('rowformat.{:d}'.format(n),
+            lambda layout=layout: layout.format(
+                rowdata, 0x12340, screen.NROWS - 1, table))
+    edited = document.Document(docname, True)
+    add('document.insert',
+        lambda: edited.insert(rand.randrange(edited.size), 'ab'))
+    add('document.delete',
+        lambda: edited.delete(rand.randrange(edited.size - 2), 2))
+    add('document.read',
+        lambda: edited.read(rand.randrange(edited.size), 384))
+    typing = [rand.randrange(edited.size - 4096), 0]
+    def typebyte():
+        #both hex digits of the next byte of a run typed in overwrite mode
+        offset = typing[0] + typing[1]
+        edited[offset] = 0x0a
+        edited[offset] = 0xab
+        typing[1] = (typing[1] + 1) & 4095
+        if typing[1] == 0:
+            edited.journal.seal()
+    add('document.type', typebyte)
+    add('document.undo', edited.undo)
+    patched = document.Document(docname, True)
+    def patchbyte():
+        patched[rand.randrange(patched.size)] = rand.randrange(256)
+    add('document.save', patched.save, patchbyte)
+    #saving a 16 MiB file after inserting a byte rewrites all of it
+    rewrittenname = os.path.join(tempdir, 'rewritten.bin')
+    with open(rewrittenname, 'wb') as f:
+        f.write(fill[: 1024] * (16 << 10))
+    rewritten = document.Document(rewrittenname, True)
+    def insertbyte():
+        rewritten.insert(rand.randrange(rewritten.size), 'x')
+    add('document.saveas', rewritten.save, insertbyte)
+    #font loading, without and with a glyph cache
+    def loadfont():
+        for discard in hexedit.loadfont():
+            pass
+    def nocache():
+        hexedit.prefs['font.cachedir'] = ''
+    def withcache():
+        hexedit.prefs['font.cachedir'] = os.path.join(tempdir, 'cache')
+    add('loadfont.uncached', loadfont, nocache)
+    add('loadfont.cached', loadfont, withcache)
+    withcache()
+    with Quiet():
+        loadfont()
+    nocache()
+    #packfont, downsampling one synthetic graphics page
+    try:
+        import png
+    except ImportError:
+        png = None
+    if png is not None:
+        pfdir = os.path.join(tempdir, 'packfont')
+        os.mkdir(pfdir)
+        with open(os.path.join(pfdir, 'bench.srcfdef.txt'), 'w') as f:
+            f.write('SRCF Def\n1855\nname=Bench\ncellwidth=a\n'
+                    'cellheight=18\ndefaultpreset=Default:asc\n'
+                    'BASESET=Bench ASCII\nref=asc\nucp=00-ff:00-ff\n'
+                    'cflags=00-ff:10*\ngraphics=bench.png\nEND\n')
+        with open(os.path.join(pfdir, 'bench.png'), 'wb') as f:
+            png.Writer(16 * 30, 16 * 18, greyscale=True, bitdepth=1).write(
+                f, [[rand.randrange(2) for x in xrange(16 * 30)]
+                    for y in xrange(16 * 18)])
+        def packfont():
+            argv = sys.argv
+            sys.argv = ['packfont.py', '-j1',
+                        os.path.join(pfdir, 'bench.srcfdef.txt'),
+                        os.path.join(pfdir, 'bench.srcf')]
+            try:
+                runpy.run_path(os.path.join(basepath, 'fontsrc',
+                                            'packfont.py'),
+                               run_name='__main__')
+            finally:
+                sys.argv = argv
+        add('packfont', packfont)
+    return results
+
+
+def compare(results, baseline, tolerance):
+    #print each result beside its baseline; return the names of those
+    #whose rate fell by more than tolerance percent
+    regressions = []
+    print '{:<24s}{:>12s}{:>10s}{:>10s}{:>10s}'.format(
+        'benchmark', 'ops/s', 'p50 ms', 'p90 ms', 'p99 ms')
+    for name, stats in results:
+        line = '{:<24s}{:>12.1f}{:>10.3f}{:>10.3f}{:>10.3f}'.format(
+            name, *stats)
+        if name in baseline:
+            change = (stats[0] / baseline[name][0] - 1) * 100
+            line += '  {:+6.1f}%'.format(change)
+            if change < -tolerance:
+                line += '  REGRESSION'
+                regressions.append(name)
+        print line
+    return regressions
+
+
+def loadbaseline(filename):
+    #return {name: (ops/s, p50, p90, p99)} from a baseline file
+    baseline = {}
+    try:
+        with open(filename, 'r') as f:
+            if f.readline().rstrip('\r\n') != BASELINESIG:
+                print 'Warning: {:s} is not a benchmark baseline' \
+                      .format(filename)
+                return baseline
+            for line in f:
+                fields = line.split()
+                if len(fields) == 5:
+                    baseline[fields[0]] = tuple(float(v)
+                                                for v in fields[1 :])
+    except (IOError, ValueError):
+        pass
+    return baseline
+
+
+def main():
+    progname = os.path.basename(sys.argv[0])
+    #-save writes the results as the new baseline; -bFILE uses another
+    #baseline file, -tN flags drops of more than N percent, -sN runs each
+    #benchmark for N seconds, and -pKEY=VALUE overrides a preference
+    save = False
+    baselinename = os.path.join(basepath, 'benchmark.baseline')
+    tolerance = 20.0
+    seconds = 1.0
+    prefs = {}
+    names = []
+    try:
+        for arg in sys.argv[1 :]:
+            if arg == '-save':
+                save = True
+            elif arg.startswith('-b') and len(arg) > 2:
+                baselinename = arg[2 :]
+            elif arg.startswith('-t'):
+                tolerance = float(arg[2 :])
+            elif arg.startswith('-s'):
+                seconds = float(arg[2 :])
+            elif arg.startswith('-p') and '=' in arg:
+                k, s, v = arg[2 :].partition('=')
+                prefs[k] = v
+            elif arg.startswith('-'):
+                raise ValueError(arg)
+            else:
+                names.append(arg)
+    except ValueError:
+        print 'Usage: {:s} [name ...] [-save] [-bFILE] [-tN] [-sN] ' \
+              '[-pKEY=VALUE]'.format(progname)
+        return 1
+    tempdir = tempfile.mkdtemp(prefix='g-she-bench')
+    sdl2.SDL_Init(0)
+    try:
+        hexedit.prefs = {}
+        hexedit.loadprefs(os.devnull)
+        hexedit.prefs['font.file'] = os.path.join(basepath, 'temoro.srcf')
+        hexedit.prefs['font.cachedir'] = ''
+        hexedit.prefs.update(prefs)
+        charcells = [None] * 256
+        basicfont, basicfontdata = scrbuf.defaultfont(0xaaaaaa, 0x0, 10, 24)
+        for a in hexedit.cellcolors:
+            charcells[a] = basicfont
+        hexedit.screen = scrbuf.headless(charcells, 10, 24,
+                                         hexedit.prefs['screen.backend'])
+        hexedit.fontmemory = {}
+        hexedit.fontbaker = None
+        hexedit.loadedfontpack = None
+        hexedit.loadedfonthash = None
+        with Quiet():
+            for discard in hexedit.loadfont():
+                pass
+        results = []
+        for name, setup, op in cases(tempdir):
+            if len(names) > 0 and not any(name.startswith(n)
+                                          for n in names):
+                continue
+            with Quiet():
+                times = timeop(setup, op, seconds)
+            results.append((name, stats(times)))
+        regressions = compare(results, loadbaseline(baselinename),
+                              tolerance)
+        if save:
+            savebaseline(baselinename, results)
+            print 'Saved baseline {:s}'.format(baselinename)
+        elif len(regressions) > 0:
+            print '{:d} regression(s) beyond {:g}%: {:s}'.format(
+                len(regressions), tolerance, ' '.join(regressions))
+            return 1
+        return 0
+    finally:
+        shutil.rmtree(tempdir, True)
+
+
+def readfont(filename):
+    #return (rootdict, basesets, extsets, gpages) from a SRCF file
+    with open(filename, 'rb') as f:
+        data = f.read()
+    if data.startswith(hexedit.SRCF2SIG):
+        return hexedit.readsrcf2(data)
+    return pickle.loads(zlib.decompress(data[19 :]))
+
+
+def savebaseline(filename, results):
+    #merge results into the baseline file, keeping benchmarks not run
+    baseline = loadbaseline(filename)
+    baseline.update(results)
+    with open(filename, 'w') as f:
+        f.write(BASELINESIG + '\n')
+        for name in sorted(baseline):
+            f.write('{:s} {:.1f} {:.4f} {:.4f} {:.4f}\n'.format(
+                name, *baseline[name]))
+
+
+def stats(times):
+    #return (ops/s, p50, p90, p99 in milliseconds) for per-op times in
+    #seconds
+    times = sorted(times)
+    n = len(times)
+    return ((n / sum(times)) if sum(times) > 0 else float('inf'),
+            times[n // 2] * 1000,
+            times[min(n * 9 // 10, n - 1)] * 1000,
+            times[min(n * 99 // 100, n - 1)] * 1000)
+
+
+def timeop(setup, op, seconds, minops=5):
+    #return the times of calls to op, repeated for at least seconds of
+    #timed work and at least minops times, after one untimed warmup call
+    if setup is not None:
+        setup()
+    op()
+    times = []
+    clock = hexedit.monotonic
+    total = 0.0
+    while total < seconds or len(times) < minops:
+        if setup is not None:
+            setup()
+        t0 = clock()
+        op()
+        t = clock() - t0
+        times.append(t)
+        total += t
+    return times
+
+
+if __name__ == '__main__':
+    sys.exit(main())
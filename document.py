@@ -0,0 +1,796 @@
+'''
+Memory-mapped file documents for G-SHE, addressed by byte offset and
+edited through a piece table
+'''
+
+import bisect, ctypes, ctypes.util, errno, mmap, os, pickle, random, stat
+import tempfile
+
+
+#Piece.buf values: the mapped file, or the document's add buffer; higher
+#values are files the document was mapped from before saving as another,
+#kept while the journal refers to them
+ORIGINAL = 0
+ADDED = 1
+#estimated bytes of memory used by a journal record, and by each span
+RECORDMEMORY = 136
+SPANMEMORY = 112
+#most bytes read and written at once when saving
+SAVECHUNK = 1 << 20
+#most bytes copied by the kernel between progress reports when saving as
+COPYCHUNK = 64 << 20
+#errors meaning a kernel copy function cannot handle these files at all
+COPYERRORS = (errno.ENOSYS, errno.EXDEV, errno.EINVAL, errno.EOPNOTSUPP,
+              errno.EPERM, errno.EBADF)
+
+#kernel functions copying between files without passing the bytes through
+#user space, most preferred first; Python 2 has neither os.copy_file_range
+#nor os.sendfile, so they are called from the C library where it has them
+copyfunctions = []
+try:
+    _libc = ctypes.CDLL(ctypes.util.find_library('c'), use_errno=True)
+except (OSError, TypeError):
+    _libc = None
+if hasattr(_libc, 'copy_file_range'):
+    _libc.copy_file_range.argtypes = (ctypes.c_int,
+                                      ctypes.POINTER(ctypes.c_int64),
+                                      ctypes.c_int,
+                                      ctypes.POINTER(ctypes.c_int64),
+                                      ctypes.c_size_t, ctypes.c_uint)
+    _libc.copy_file_range.restype = ctypes.c_ssize_t
+    copyfunctions.append('copy_file_range')
+if hasattr(_libc, 'sendfile64'):
+    _libc.sendfile64.argtypes = (ctypes.c_int, ctypes.c_int,
+                                 ctypes.POINTER(ctypes.c_int64),
+                                 ctypes.c_size_t)
+    _libc.sendfile64.restype = ctypes.c_ssize_t
+    copyfunctions.append('sendfile64')
+
+
+class Document(object):
+
+    def __init__(self, filename, writable=False, undomemory=4 << 20):
+        #map filename read-only, so that opening takes the same time and
+        #memory for any size of file and only the pages actually read are
+        #ever loaded from disk; edits go to an append-only add buffer, and
+        #a balanced tree of pieces over the two gives the current content;
+        #a writable document journals its edits for undo, keeping about
+        #undomemory bytes of history in memory
+        self.filename = filename
+        self.writable = writable
+        self.journal = Journal(undomemory) if writable else None
+        self.file = open(filename, 'rb')
+        self.size = os.fstat(self.file.fileno()).st_size
+        self.filesize = self.size
+        if self.size > 0:
+            self.data = mmap.mmap(self.file.fileno(), 0,
+                                  access=mmap.ACCESS_READ)
+            self.root = Piece(ORIGINAL, 0, self.size)
+        else:
+            #empty files cannot be mapped
+            self.data = ''
+            self.root = None
+        self.added = bytearray()
+        self.buffers = [self.data, self.added]
+        #a file saved by save or saveAs but not yet reopened, and the
+        #(offset, bytes) its own file held before a save in place wrote
+        #over them, which the journal may still refer to
+        self.pendingfile = None
+        self.overwritten = None
+        return
+
+    def __getitem__(self, key):
+        #the byte value at an offset, or a string of the bytes in a slice
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.size)
+            if step != 1:
+                return self.read(0, self.size)[start : stop : step]
+            return self.read(start, stop - start)
+        if key < 0:
+            key += self.size
+        if not 0 <= key < self.size:
+            raise IndexError('document offset out of range')
+        return ord(self.read(key, 1))
+
+    def __len__(self):
+        return self.size
+
+    def __setitem__(self, key, value):
+        #overwrite bytes without changing the size of the document; value
+        #is a byte value for an offset, or a string for a slice
+        if isinstance(key, slice):
+            start, stop, step = key.indices(self.size)
+            if step != 1 or len(value) != stop - start:
+                raise ValueError('document slices cannot change size')
+            self.replace(start, stop - start, value)
+            return
+        if key < 0:
+            key += self.size
+        if not 0 <= key < self.size:
+            raise IndexError('document offset out of range')
+        self.replace(key, 1, chr(value))
+
+    def checkEdit(self, offset, length=0):
+        #raise unless the document may be edited at offset..offset+length
+        if not self.writable:
+            raise TypeError('document is read-only')
+        if not 0 <= offset <= offset + length <= self.size:
+            raise IndexError('document offset out of range')
+
+    def close(self):
+        for data in self.buffers:
+            if isinstance(data, mmap.mmap):
+                data.close()
+        self.data = ''
+        self.buffers = [self.data, self.added]
+        self.root = None
+        self.size = 0
+        self.file.close()
+        return
+
+    def delete(self, offset, length):
+        #remove length bytes at offset
+        self.edit(offset, length, ())
+        return
+
+    def edit(self, offset, length, spans, journal=True):
+        #replace length bytes at offset with spans, a sequence of (buffer,
+        #start, length) references into the document's buffers, recording
+        #the edit in the journal unless journal is false; return the
+        #removed bytes as spans
+        self.checkEdit(offset, length)
+        if length == 0 and len(spans) == 0:
+            return ()
+        removed = tuple((buf, start, n)
+                        for docoffset, buf, start, n
+                        in self.pieces(offset, length))
+        head, rest = _split(self.root, offset)
+        middle, tail = _split(rest, length)
+        added = 0
+        for buf, start, n in spans:
+            #typing at the end of the last insertion just lengthens its
+            #piece
+            if not _extendlast(head, buf, start, n):
+                head = _merge(head, Piece(buf, start, n))
+            added += n
+        self.root = _merge(head, tail)
+        self.size += added - length
+        if journal and self.journal is not None:
+            self.journal.record(offset, removed, tuple(spans))
+        return removed
+
+    def insert(self, offset, data):
+        #insert the string data at offset, storing only data itself
+        self.replace(offset, 0, data)
+        return
+
+    def modifiedExtents(self):
+        #return the sorted (offset, length) ranges where the document
+        #differs from its file, or may do: those not read from the same
+        #place in the file
+        extents = []
+        for docoffset, buf, start, n in self.pieces():
+            if buf == ORIGINAL and start == docoffset:
+                continue
+            if len(extents) > 0 and sum(extents[-1]) == docoffset:
+                extents[-1] = (extents[-1][0], extents[-1][1] + n)
+            else:
+                extents.append((docoffset, n))
+        return extents
+
+    def pieces(self, offset=0, length=None):
+        #yield (document offset, buffer, start, length) for each run of
+        #bytes from offset, through length bytes or the end of the document
+        if length is None:
+            length = self.size - offset
+        offset = max(0, min(offset, self.size))
+        stop = min(offset + max(length, 0), self.size)
+        if offset < stop:
+            for run in _runs(self.root, 0, offset, stop):
+                yield run
+
+    def read(self, offset, length):
+        #return up to length bytes from offset, fewer at the end of the
+        #document; only the pieces in range are visited
+        chunks = []
+        buffers = self.buffers
+        for docoffset, buf, start, n in self.pieces(offset, length):
+            if buf == ADDED:
+                chunks.append(str(buffer(buffers[buf], start, n)))
+            else:
+                chunks.append(buffers[buf][start : start + n])
+        if len(chunks) == 1:
+            return chunks[0]
+        return ''.join(chunks)
+
+    def redo(self):
+        #redo the last undone edit; return its offset, or None if there
+        #is nothing to redo
+        record = self.journal.redo() if self.journal is not None else None
+        if record is None:
+            return None
+        offset, removed, inserted = record
+        self.edit(offset, _spanslength(removed), inserted, False)
+        return offset
+
+    def reopen(self, filename=None):
+        #map the document from filename, by default the file last saved
+        #without reopening, which must hold exactly its content; the old
+        #file stays mapped as another buffer while the journal refers to
+        #it; after a save in place, the journal is pointed at copies of
+        #the bytes written over, and the file already mapped is used
+        if filename is None:
+            filename = self.pendingfile
+        self.pendingfile = None
+        overwritten, self.overwritten = self.overwritten, None
+        if overwritten is not None:
+            copies = []
+            for offset, old in overwritten:
+                copies.append((offset, offset + len(old), len(self.added)))
+                self.added.extend(old)
+            if len(copies) > 0:
+                self.journal.remap(lambda spans: _remapspans(spans, copies))
+            if filename == self.filename:
+                self.root = Piece(ORIGINAL, 0, self.size) \
+                            if self.size > 0 else None
+                return
+        f = open(filename, 'rb')
+        size = os.fstat(f.fileno()).st_size
+        if size != self.size:
+            f.close()
+            raise ValueError('file does not hold the document')
+        data = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ) \
+               if size > 0 else ''
+        if self.journal is not None and self.journal.size() > 0:
+            old = len(self.buffers)
+            self.buffers.append(self.data)
+            self.journal.remap(lambda spans: tuple(
+                (old if buf == ORIGINAL else buf, start, n)
+                for buf, start, n in spans))
+        elif isinstance(self.data, mmap.mmap):
+            self.data.close()
+        self.file.close()
+        self.file = f
+        self.filename = filename
+        self.filesize = size
+        self.data = data
+        self.buffers[ORIGINAL] = data
+        self.root = Piece(ORIGINAL, 0, size) if size > 0 else None
+        return
+
+    def replace(self, offset, length, data):
+        #replace length bytes at offset with the string data
+        self.checkEdit(offset, length)
+        if length == 1 and len(data) == 1 and self.journal is not None \
+               and self.journal.coalesce:
+            last = self.journal.undos.top()
+            end = len(self.added)
+            if last is not None and len(last[2]) > 0 \
+                   and last[2][-1][0] == ADDED \
+                   and last[2][-1][1] + last[2][-1][2] == end:
+                docoffset, buf, start, n = next(self.pieces(offset, 1))
+                if buf == ADDED and start == end - 1:
+                    #rewriting the byte the open journal record just
+                    #inserted, as with the second hex digit typed into a
+                    #byte: nothing else refers to it, so change it in place
+                    self.added[start] = data
+                    return
+        start = len(self.added)
+        self.added.extend(data)
+        self.edit(offset, length, ((ADDED, start, len(data)), )
+                                  if len(data) > 0 else ())
+        return
+
+    def save(self, progress=None, reopen=True):
+        #write the document back over its file; if it is the same size,
+        #write only the modified extents in offset order and then sync
+        #once, otherwise save as its own file, passing on reopen;
+        #progress(done, total) is called after each chunk and cancels the
+        #save by returning False, when the bytes already written over are
+        #put back; unless reopen is false, the document is then reopened,
+        #and otherwise that is left to a reopen() call from the thread
+        #reading the document, which must not be edited or undone until
+        #then; return the number of bytes written, or None if cancelled
+        if not self.writable:
+            raise TypeError('document is read-only')
+        if self.pendingfile is not None:
+            raise ValueError('document not reopened since its last save')
+        if self.size != self.filesize:
+            return self.saveAs(None, progress, reopen)
+        extents = self.modifiedExtents()
+        if len(extents) == 0:
+            return 0
+        #bytes moved within the file must not be overwritten before they
+        #are copied to their new places, so rewrite the whole file instead
+        starts = [offset for offset, length in extents]
+        for docoffset, buf, start, n in self.pieces():
+            if buf == ORIGINAL and start != docoffset:
+                i = bisect.bisect_right(starts, start + n - 1) - 1
+                if i >= 0 and sum(extents[i]) > start:
+                    return self.saveAs(None, progress, reopen)
+        #keep the file bytes about to be overwritten for the journal, and
+        #to put back if the save is cancelled
+        keep = self.journal is not None and self.journal.size() > 0
+        kept = None
+        if keep or progress is not None:
+            kept = [(offset, self.data[offset : offset + length])
+                    for offset, length in extents]
+        total = sum(length for offset, length in extents)
+        written = 0
+        fd = os.open(self.filename, os.O_WRONLY)
+        try:
+            for i, (offset, length) in enumerate(extents):
+                #os.pwrite is not available before Python 3.3
+                os.lseek(fd, offset, os.SEEK_SET)
+                end = offset + length
+                while offset < end:
+                    data = self.read(offset, min(end - offset, SAVECHUNK))
+                    _writeall(fd, data)
+                    offset += len(data)
+                    written += len(data)
+                    if progress is not None \
+                           and progress(written, total) is False:
+                        for offset, old in kept[: i + 1]:
+                            os.lseek(fd, offset, os.SEEK_SET)
+                            _writeall(fd, old)
+                        os.fsync(fd)
+                        return None
+            os.fsync(fd)
+        finally:
+            os.close(fd)
+        #the mapped file now holds the whole document
+        self.overwritten = kept if keep else []
+        if reopen:
+            self.reopen(self.filename)
+        else:
+            self.pendingfile = self.filename
+        return written
+
+    def saveAs(self, filename=None, progress=None, reopen=True):
+        #write the whole document to filename, by default its own file,
+        #through a temporary file in the same directory that is synced and
+        #then renamed over it, so that filename always holds either the old
+        #or the new content; the kernel copies unmodified file bytes where
+        #it can, so only added bytes pass through Python; progress(done,
+        #total) is called after each chunk and cancels the save by
+        #returning False; afterwards the document is mapped from filename,
+        #unless reopen is false, when that is left to a reopen() call from
+        #the thread reading the document, which until then still reads
+        #the old file; return the number of bytes written, or None if
+        #cancelled
+        if filename is None:
+            filename = self.filename
+        directory = os.path.dirname(os.path.abspath(filename))
+        fd, tempname = tempfile.mkstemp(prefix='.g-she', dir=directory)
+        written = 0
+        try:
+            infd = self.file.fileno()
+            for docoffset, buf, start, n in self.pieces():
+                end = start + n
+                while start < end:
+                    if buf == ORIGINAL:
+                        k = _copyrange(infd, self.data, start, fd,
+                                       min(end - start, COPYCHUNK))
+                    else:
+                        k = os.write(fd, self.buffers[buf][start : min(
+                                end, start + SAVECHUNK)])
+                    start += k
+                    written += k
+                    if progress is not None \
+                           and progress(written, self.size) is False:
+                        os.close(fd)
+                        fd = None
+                        os.remove(tempname)
+                        return None
+            os.fsync(fd)
+            os.close(fd)
+            fd = None
+            #keep the permissions of a file being replaced; mkstemp makes
+            #files only their owner can read
+            try:
+                mode = stat.S_IMODE(os.stat(filename).st_mode)
+            except OSError:
+                mode = 0666 & ~_umask()
+            os.chmod(tempname, mode)
+            if os.name == 'nt' and os.path.exists(filename):
+                #Windows cannot rename over an existing file, and Python 2
+                #lacks os.replace
+                os.remove(filename)
+            os.rename(tempname, filename)
+        except:
+            if fd is not None:
+                os.close(fd)
+            if os.path.exists(tempname):
+                os.remove(tempname)
+            raise
+        if reopen:
+            self.reopen(filename)
+        else:
+            self.pendingfile = filename
+        return written
+
+    def undo(self):
+        #undo the last edit; return its offset, or None if there is
+        #nothing to undo
+        record = self.journal.undo() if self.journal is not None else None
+        if record is None:
+            return None
+        offset, removed, inserted = record
+        self.edit(offset, _spanslength(inserted), removed, False)
+        return offset
+
+
+class HistoryStack(object):
+
+    def __init__(self, maxmemory):
+        #a stack of journal records keeping the newest in memory, up to
+        #about maxmemory bytes, and pickling older ones in chunks to a
+        #temporary file
+        self.maxmemory = maxmemory
+        self.records = []
+        self.memory = 0
+        #(file offset, length, records) of each spilled chunk, oldest first
+        self.spilled = []
+        self.file = None
+        return
+
+    def __len__(self):
+        return len(self.records) + sum(chunk[2] for chunk in self.spilled)
+
+    def clear(self):
+        self.records = []
+        self.memory = 0
+        self.spilled = []
+        if self.file is not None:
+            self.file.close()
+            self.file = None
+        return
+
+    def pop(self):
+        #remove and return the newest record, or None if there are none
+        if len(self.records) == 0:
+            if len(self.spilled) == 0:
+                return None
+            fileoffset, length, count = self.spilled.pop()
+            self.file.seek(fileoffset)
+            self.records = pickle.loads(self.file.read(length))
+            self.file.seek(fileoffset)
+            self.file.truncate()
+            self.memory = sum(_recordmemory(r) for r in self.records)
+        record = self.records.pop()
+        self.memory -= _recordmemory(record)
+        return record
+
+    def push(self, record):
+        self.records.append(record)
+        self.memory += _recordmemory(record)
+        if self.memory > self.maxmemory and len(self.records) > 1:
+            self.spill()
+        return
+
+    def remap(self, fn):
+        #replace every record with fn(record), including those spilled
+        self.records = [fn(record) for record in self.records]
+        self.memory = sum(_recordmemory(r) for r in self.records)
+        if len(self.spilled) == 0:
+            return
+        spilled = []
+        newfile = tempfile.TemporaryFile(prefix='g-she-undo')
+        for fileoffset, length, count in self.spilled:
+            self.file.seek(fileoffset)
+            data = pickle.dumps([fn(record) for record
+                                 in pickle.loads(self.file.read(length))],
+                                -1)
+            spilled.append((newfile.tell(), len(data), count))
+            newfile.write(data)
+        self.file.close()
+        self.file = newfile
+        self.spilled = spilled
+        return
+
+    def spill(self):
+        #write the oldest records holding about half the memory to the
+        #temporary file
+        if self.file is None:
+            self.file = tempfile.TemporaryFile(prefix='g-she-undo')
+        memory = 0
+        n = 0
+        while n < len(self.records) - 1 and memory < self.memory // 2:
+            memory += _recordmemory(self.records[n])
+            n += 1
+        self.file.seek(0, os.SEEK_END)
+        data = pickle.dumps(self.records[: n], -1)
+        self.spilled.append((self.file.tell(), len(data), n))
+        self.file.write(data)
+        del self.records[: n]
+        self.memory -= memory
+        return
+
+    def top(self):
+        #the newest record if it is in memory, else None
+        return self.records[-1] if len(self.records) > 0 else None
+
+
+class Journal(object):
+
+    def __init__(self, maxmemory=4 << 20):
+        #undo and redo histories of (offset, removed spans, inserted spans)
+        #records, which refer to bytes in the mapped file or add buffer
+        #instead of copying them; together they keep about maxmemory bytes
+        #in memory
+        self.undos = HistoryStack(maxmemory // 2)
+        self.redos = HistoryStack(maxmemory // 2)
+        #whether the next single byte edit may join the newest record
+        self.coalesce = False
+        return
+
+    def record(self, offset, removed, inserted):
+        #add an edit, joining consecutive single byte edits into one
+        #record: those continuing just after it, and those rewriting bytes
+        #it inserted (such as the second hex digit typed into a byte); a
+        #longer edit, such as a paste, keeps a record of its own
+        self.redos.clear()
+        last = self.undos.top()
+        if self.coalesce and last is not None \
+               and _spanslength(removed) <= 1 \
+               and _spanslength(inserted) <= 1:
+            lastoffset, lastremoved, lastinserted = last
+            n = _spanslength(lastinserted)
+            end = offset + _spanslength(removed)
+            if offset == lastoffset + n:
+                self.undos.pop()
+                self.undos.push((lastoffset,
+                                 _joinspans(lastremoved, removed),
+                                 _joinspans(lastinserted, inserted)))
+                return
+            if lastoffset <= offset and end <= lastoffset + n:
+                self.undos.pop()
+                self.undos.push((lastoffset,
+                                 lastremoved,
+                                 _joinspans(
+                                     _joinspans(
+                                         _cutspans(lastinserted,
+                                                   0, offset - lastoffset),
+                                         inserted),
+                                     _cutspans(lastinserted,
+                                               end - lastoffset, n))))
+                return
+        self.undos.push((offset, removed, inserted))
+        self.coalesce = _spanslength(removed) <= 1 \
+                        and _spanslength(inserted) <= 1
+        return
+
+    def redo(self):
+        #move the newest undone record back to the undo history and
+        #return it, or None
+        record = self.redos.pop()
+        if record is not None:
+            self.undos.push(record)
+        self.coalesce = False
+        return record
+
+    def remap(self, fn):
+        #replace the spans of every record with fn(spans)
+        def remap(record):
+            return (record[0], fn(record[1]), fn(record[2]))
+        self.undos.remap(remap)
+        self.redos.remap(remap)
+        return
+
+    def seal(self):
+        #keep the next edit out of the newest record, e.g. after the cursor
+        #has moved
+        self.coalesce = False
+        return
+
+    def size(self):
+        #the number of records in both histories
+        return len(self.undos) + len(self.redos)
+
+    def undo(self):
+        #move the newest record to the redo history and return it, or None
+        record = self.undos.pop()
+        if record is not None:
+            self.redos.push(record)
+        self.coalesce = False
+        return record
+
+
+class Piece(object):
+    #a run of length bytes from start in buffer buf (ORIGINAL, ADDED or an
+    #earlier file), as a node of a treap ordered by document offset; total
+    #is the length of all the pieces in the subtree
+    __slots__ = ('buf', 'start', 'length', 'total', 'priority',
+                 'left', 'right')
+
+    def __init__(self, buf, start, length):
+        self.buf = buf
+        self.start = start
+        self.length = length
+        self.total = length
+        self.priority = random.random()
+        self.left = None
+        self.right = None
+
+
+def _copyrange(infd, data, offset, outfd, length):
+    #copy up to length bytes from offset in infd, which data maps, to the
+    #current position of outfd, in the kernel where it can; return the
+    #number of bytes copied
+    while len(copyfunctions) > 0:
+        inoffset = ctypes.c_int64(offset)
+        if copyfunctions[0] == 'copy_file_range':
+            n = _libc.copy_file_range(infd, ctypes.byref(inoffset), outfd,
+                                      None, length, 0)
+        else:
+            n = _libc.sendfile64(outfd, infd, ctypes.byref(inoffset),
+                                 length)
+        if n > 0:
+            return n
+        if n == 0:
+            #the end of the file; let the mapping decide
+            break
+        error = ctypes.get_errno()
+        if error in COPYERRORS:
+            #unsupported here, e.g. across file systems or kernels; fall
+            #back to the next function for the rest of the session
+            del copyfunctions[0]
+        elif error != errno.EINTR:
+            raise OSError(error, os.strerror(error))
+    chunk = data[offset : offset + min(length, SAVECHUNK)]
+    if len(chunk) == 0:
+        raise IOError('file is shorter than the document expects')
+    return os.write(outfd, chunk)
+
+
+def _cutspans(spans, begin, end):
+    #the spans covering bytes begin..end of the bytes of spans
+    cut = []
+    offset = 0
+    for buf, start, n in spans:
+        a = max(begin, offset)
+        b = min(end, offset + n)
+        if a < b:
+            cut.append((buf, start + a - offset, b - a))
+        offset += n
+    return tuple(cut)
+
+
+def _extendlast(node, buf, start, length):
+    #if the last piece under node continues exactly into start of buf,
+    #lengthen it by length and return True
+    if node is None:
+        return False
+    if node.right is not None:
+        if not _extendlast(node.right, buf, start, length):
+            return False
+    elif node.buf != buf or node.start + node.length != start:
+        return False
+    else:
+        node.length += length
+    node.total += length
+    return True
+
+
+def _joinspans(a, b):
+    #the spans of a followed by those of b, joining contiguous neighbours
+    if len(a) > 0 and len(b) > 0 and a[-1][0] == b[0][0] \
+           and a[-1][1] + a[-1][2] == b[0][1]:
+        return a[: -1] + ((a[-1][0], a[-1][1], a[-1][2] + b[0][2]), ) \
+               + b[1 :]
+    return a + b
+
+
+def _merge(a, b):
+    #join two trees, all of a's pieces coming before b's
+    if a is None:
+        return b
+    if b is None:
+        return a
+    if a.priority > b.priority:
+        a.right = _merge(a.right, b)
+        _update(a)
+        return a
+    b.left = _merge(a, b.left)
+    _update(b)
+    return b
+
+
+def _recordmemory(record):
+    return RECORDMEMORY + SPANMEMORY * (len(record[1]) + len(record[2]))
+
+
+def _remapspans(spans, copies):
+    #spans with the ORIGINAL bytes in each (begin, end, added offset) of
+    #copies redirected to their copy in the add buffer
+    remapped = ()
+    for buf, start, n in spans:
+        if buf != ORIGINAL:
+            remapped = _joinspans(remapped, ((buf, start, n), ))
+            continue
+        end = start + n
+        i = max(bisect.bisect_right(copies, (start, )) - 1, 0)
+        while start < end:
+            while i < len(copies) and copies[i][1] <= start:
+                i += 1
+            if i == len(copies) or end <= copies[i][0]:
+                part = ((ORIGINAL, start, end - start), )
+                stop = end
+            elif start < copies[i][0]:
+                part = ((ORIGINAL, start, copies[i][0] - start), )
+                stop = copies[i][0]
+            else:
+                stop = min(end, copies[i][1])
+                part = ((ADDED, copies[i][2] + start - copies[i][0],
+                         stop - start), )
+            remapped = _joinspans(remapped, part)
+            start = stop
+    return remapped
+
+
+def _runs(node, base, offset, stop):
+    #yield (document offset, buffer, start, length) for the parts of the
+    #pieces under node, whose first byte is at base, within offset..stop
+    while node is not None:
+        left = node.left.total if node.left is not None else 0
+        begin = base + left
+        end = begin + node.length
+        if offset < begin:
+            for run in _runs(node.left, base, offset, stop):
+                yield run
+        if offset < end and begin < stop:
+            a = max(offset, begin)
+            yield (a, node.buf, node.start + a - begin, min(stop, end) - a)
+        if stop <= end:
+            return
+        base = end
+        node = node.right
+
+
+def _split(node, offset):
+    #split the tree at node into trees of its first offset bytes and the
+    #rest, cutting the piece that spans offset in two
+    if node is None:
+        return None, None
+    left = node.left.total if node.left is not None else 0
+    if offset <= left:
+        a, b = _split(node.left, offset)
+        node.left = b
+        _update(node)
+        return a, node
+    if offset >= left + node.length:
+        a, b = _split(node.right, offset - left - node.length)
+        node.right = a
+        _update(node)
+        return node, b
+    cut = offset - left
+    tail = Piece(node.buf, node.start + cut, node.length - cut)
+    node.length = cut
+    rest = node.right
+    node.right = None
+    _update(node)
+    return node, _merge(tail, rest)
+
+
+def _spanslength(spans):
+    return sum(span[2] for span in spans)
+
+
+def _umask():
+    #the process umask, which can only be read by setting it
+    mask = os.umask(0)
+    os.umask(mask)
+    return mask
+
+
+def _update(node):
+    node.total = node.length \
+                 + (node.left.total if node.left is not None else 0) \
+                 + (node.right.total if node.right is not None else 0)
+
+
+def _writeall(fd, data):
+    #write all of data at the current position of fd
+    while len(data) > 0:
+        n = os.write(fd, data)
+        data = data[n :]
@@ -3,8 +3,11 @@
 
 import array
 import itertools
+import mmap
+import multiprocessing
 import pickle
 import os
+import struct
 import sys
 import zlib
 
@@ -110,6 +113,62 @@ def dedundify(item):
     return common_object(item)
 
 
+def downsample(gsource):
+    #draw the characters of one graphics page into its shared buffer in
+    #gpbufs, without touching gpages; return (gsource, characters drawn),
+    #with None in place of the list if the graphics file is invalid
+    global warnsonienable
+    gfxfilename = os.path.join(defbasepath, gsource)
+    gp = gpages[gsource]
+    buf = gpbufs[gsource]
+    drawn = []
+    try:
+     with tryopen(gfxfilename, 'rb', gfxexts) as gf:
+        print 'Loading graphics file {:s}...'.format(gf.name)
+        gfw, gfh, gfp, gfm = png.Reader(file=gf).read()
+        gfp = iter(gfp)
+        gfncol = gfw // fcw
+        c = 0
+        gfc = 0
+        while c < 256:
+            try:
+                pix = [[1 if p > 0 else 0
+                        for p in next(gfp)]
+                       for y in xrange(fch)]
+            except StopIteration:
+                print 'Warning: too few rows in graphics source file'
+                break
+            while c < 256:
+                gfsc = gfc * fcw
+                if gp[c] is not None:
+                    if gp[c] & 0x1000000 and warnsonienable:
+                        print 'Warning: smoothing override not implemented.'
+                        warnsonienable = False
+                    cp = fcw * fch * c
+                    for y in xrange(fch):
+                        for x in xrange(fcw):
+                            v = 0
+                            for sx, m in dskernel[x]:
+                                v += pix[y][sx + gfsc] * m
+                            buf[cp] = chr(v)
+                            cp += 1
+                    drawn.append(c)
+                c += 1
+                gfc += 1
+                if gfc >= gfncol:
+                    gfc = 0
+                    break
+        del pix
+        del gfp
+    except IOError:
+        print 'Warning: failed to open graphics file {:s}'.format(gsource)
+    except png.FormatError:
+        print 'Warning: graphics file {:s} is not a valid PNG image file' \
+              .format(gsource)
+        drawn = None
+    return (gsource, drawn)
+
+
 def rspecdecode(rspec):
     ss, h, es = rspec.partition('-')
     if h == '-':
@@ -123,6 +182,48 @@ def rspecdecode(rspec):
     return (s, )
 
 
+def writesrcf2(ff, compress=False):
+    #write the font as SRCF v2: a fixed header, a metadata block led by
+    #the font's name, author, and license, a table of contents, and one
+    #page of glyph coverage levels per graphics source, either zlib
+    #compressed or uncompressed and 4 KiB aligned for mapping
+    glyphbytes = fcw * fch
+    meta = ''.join(struct.pack('<H', len(v)) + v
+                   for v in (unicode(v).encode('utf8')
+                             for v in rootdict[0][0 : 3]))
+    meta += pickle.dumps((rootdict, basesets, extsets), -1)
+    names = sorted(gpages)
+    pages = []
+    for gsource in names:
+        gp = [g if isinstance(g, array.array) else None
+              for g in gpages[gsource]]
+        page = ''.join('\0' if g is None else '\1' for g in gp) \
+               + ''.join('\0' * glyphbytes if g is None else g.tostring()
+                         for g in gp)
+        pages.append(zlib.compress(page, 9) if compress else page)
+    metaoffset = len(packedsig2) + 21
+    tocoffset = metaoffset + len(meta)
+    offset = tocoffset + sum(14 + len(name.encode('utf8'))
+                             for name in names)
+    toc = []
+    for name, page in itertools.izip(names, pages):
+        if not compress:
+            offset = (offset + 4095) & ~4095
+        name = name.encode('utf8')
+        toc.append(struct.pack('<IIIH', offset, len(page),
+                               1 if compress else 0, len(name)) + name)
+        offset += len(page)
+    ff.write(packedsig2)
+    ff.write(struct.pack('<xHHIIII', rootdict[0][3], rootdict[0][4],
+                         metaoffset, len(meta), tocoffset, len(names)))
+    ff.write(meta)
+    ff.write(''.join(toc))
+    for page in pages:
+        if not compress:
+            ff.write('\0' * (-ff.tell() & 4095))
+        ff.write(page)
+
+
 def tryopen(filename, filemode, extlist):
     for ext in extlist:
         try:
@@ -181,16 +282,36 @@ srcfdefexts = ('',
 gfxexts = ('',
            '.png')
 packedsig = 'SRCF binary v1860\r\n'
+packedsig2 = 'SRCF binary v2000\r\n'
 
 progname = os.path.basename(sys.argv[0])
+#-jN downsamples up to N graphics pages at once in worker processes;
+#-z compresses each glyph page, and -v1860 writes the old format instead
 try:
-    deffilename = sys.argv[1]
+    procs = multiprocessing.cpu_count()
+except NotImplementedError:
+    procs = 1
+compresspages = False
+writeversion = 2000
+argv = []
+for arg in sys.argv:
+    if arg.startswith('-j') and arg[2 :].isdigit():
+        procs = max(int(arg[2 :]), 1)
+    elif arg == '-z':
+        compresspages = True
+    elif arg == '-v1860':
+        writeversion = 1860
+    else:
+        argv.append(arg)
+try:
+    deffilename = argv[1]
 except IndexError:
-    print 'Usage: {:s} deffile [outfile [-noext]]'.format(progname)
+    print 'Usage: {:s} deffile [outfile [-noext]] [-jN] [-z] [-v1860]' \
+          .format(progname)
     sys.exit(1)
 checkext = True
 try:
-    outfilename = sys.argv[2]
+    outfilename = argv[2]
     if outfilename == '-noext':
         outfilename = None
         checkext = False
@@ -201,18 +322,18 @@ try:
 except IndexError:
     outfilename = None
 try:
-    if sys.argv[3] == '-noext':
+    if argv[3] == '-noext':
         checkext = False
         if '.' in outfilename:
             print 'Warning: switch -noext ignored'
             print '\t(specified output name {:s} already has an extension' \
                   .format(outfilename)
-        if len(sys.argv) > 4:
+        if len(argv) > 4:
             print 'Warning: command line argument(s) not understood: {:s}' \
-                  .format(' '.join(sys.argv[4 : ]))
+                  .format(' '.join(argv[4 : ]))
     else:
         print 'Warning: command line argument(s) not understood: {:s}' \
-              .format(' '.join(sys.argv[3 : ]))
+              .format(' '.join(argv[3 : ]))
 except IndexError:
     pass
 try:
@@ -376,53 +497,28 @@ for s in (  [basesets[k] for k in basesets]
         if s[0][4][c] & 0x10:
             gp[c] = s[0][4][c] & 0x7ffff00
 warnsonienable = True
-for gsource in gpages:
-  gfxfilename = os.path.join(defbasepath, gsource)
-  gp = gpages[gsource]
-  try:
-   with tryopen(gfxfilename, 'rb', gfxexts) as gf:
-    print 'Loading graphics file {:s}...'.format(gf.name)
-    gfw, gfh, gfp, gfm = png.Reader(file=gf).read()
-    gfp = iter(gfp)
-    gfncol = gfw // fcw
-    c = 0
-    gfc = 0
-    while c < 256:
-        try:
-            pix = [[1 if p > 0 else 0
-                    for p in next(gfp)]
-                   for y in xrange(fch)]
-        except StopIteration:
-            print 'Warning: too few rows in graphics source file'
-            break
-        while c < 256:
-            gfsc = gfc * fcw
-            if gp[c] is not None:
-                if gp[c] & 0x1000000 and warnsonienable:
-                    print 'Warning: smoothing override not implemented.'
-                    warnsonienable = False
-                gp[c] = array.array('B', itertools.repeat(0, fcw * fch))
-                cp = 0
-                for y in xrange(fch):
-                    for x in xrange(fcw):
-                        v = 0
-                        for sx, m in dskernel[x]:
-                            v += pix[y][sx + gfsc] * m
-                        gp[c][cp] = v
-                        cp += 1
-            c += 1
-            gfc += 1
-            if gfc >= gfncol:
-                gfc = 0
-                break
-    del pix
-    del gfp
-  except IOError:
-    print 'Warning: failed to open graphics file {:s}'.format(gsource)
-  except png.FormatError:
-    print 'Warning: graphics file {:s} is not a valid PNG image file' \
-          .format(gsource)
-    gp[ : ] = [None] * 256
+#worker processes draw into shared memory, so only the lists of drawn
+#characters come back through the pool
+n = fcw * fch
+gpbufs = {gsource: mmap.mmap(-1, n << 8) for gsource in gpages}
+if procs > 1 and len(gpages) > 1 and hasattr(os, 'fork'):
+    pool = multiprocessing.Pool(min(procs, len(gpages)))
+    results = pool.imap_unordered(downsample, gpages)
+else:
+    pool = None
+    results = itertools.imap(downsample, gpages)
+for gsource, drawn in results:
+    gp = gpages[gsource]
+    if drawn is None:
+        gp[ : ] = [None] * 256
+        continue
+    buf = gpbufs[gsource]
+    for c in drawn:
+        gp[c] = array.array('B', buf[n * c : n * (c + 1)])
+if pool is not None:
+    pool.close()
+    pool.join()
+del gpbufs
 #print rootdict
 #print basesets
 #print extsets
@@ -436,16 +532,19 @@ if checkext and (not '.' in os.path.basename(outfilename.lower())):
 try:
     with open(outfilename, 'wb') as ff:
         print 'Writing {:s}...'.format(outfilename)
-        ff.write(packedsig)
-        ff.write(
-            zlib.compress(
-                pickle.dumps(
-                    (rootdict,
-                     basesets,
-                     extsets,
-                     gpages),
-                    -1),
-                9))
+        if writeversion == 1860:
+            ff.write(packedsig)
+            ff.write(
+                zlib.compress(
+                    pickle.dumps(
+                        (rootdict,
+                         basesets,
+                         extsets,
+                         gpages),
+                        -1),
+                    9))
+        else:
+            writesrcf2(ff, compresspages)
 except IOError:
     print 'Error: Failed to write to file {:s}'.format(outfilename)
     sys.exit(2)
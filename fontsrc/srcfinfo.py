@@ -1,9 +1,19 @@
-import pickle, zlib
+import pickle, struct, zlib
 
 
 def getmeta(partialdata, allstrings=False):
     #insert newer signature check blocks at top
-    if partialdata.startswith('SRCF binary v1860\r\n'):
+    if partialdata.startswith('SRCF binary v2000\r\n'):
+        #name, author, and license lead the metadata block
+        s = []
+        p, = struct.unpack_from('<I', partialdata, 24)
+        for i in xrange(3):
+            if p + 2 > len(partialdata):
+                break
+            slen, = struct.unpack_from('<H', partialdata, p)
+            s.append(partialdata[p + 2 : p + 2 + slen])
+            p += 2 + slen
+    elif partialdata.startswith('SRCF binary v1860\r\n'):
         s = []
         expectedlen = None
         for f in zlib.decompressobj() \
@@ -4,18 +4,35 @@ A simple hex editor with a visual style inspired by the MS-DOS utility LIST.
 '''
 
 import array
+import bisect
 import collections
 import ctypes
 from heapq import heapify, heappop, heappush, heappushpop, heapreplace
+import hashlib
 import itertools
+import mmap
+import multiprocessing
 import os, os.path
-import pickle
+try:
+    import cPickle as pickle
+except ImportError:
+    import pickle
+import Queue
+import struct
 import sys
+import tempfile
+import threading
 import time
+import unicodedata
 import zlib
 
 import sdl2, sdl2.ext
+try:
+    import numpy
+except ImportError:
+    numpy = None
 
+import document
 import scrbuf
 from version import aboutstring
 
@@ -33,6 +50,31 @@ fallbacks = {u'\xa0':   (u' ',),
              u'\u25c4': (u'\u2190',u'<'),
              }
 namedencodings = {}
+#compiled altencode tables by target encoding, and recent results
+encodetables = {}
+encodecache = collections.OrderedDict()
+texttables = {}
+rowlayouts = {}
+#wraptext's recent layouts, and layouttext's dynamic programs by geometry
+layoutcache = collections.OrderedDict()
+layoutstates = collections.OrderedDict()
+#background tasks as [name, generator, idle only, last progress], stepped
+#round robin by the event loop, and TaskEvents posted by worker threads
+tasks = []
+threadevents = Queue.Queue()
+threadwake = threading.Event()
+threadcancels = {}
+#the SDLX_TASKDONE TaskEvent of each finished task, until asked for
+taskresults = {}
+#timers by name, as [interval or None, sequence number], and a heap of
+#(deadline, sequence number, name) that may hold stale entries
+timers = {}
+timerheap = []
+timerseq = itertools.count()
+perfrequency = float(sdl2.SDL_GetPerformanceFrequency())
+#when the event loop last flushed the screen, on the monotonic clock
+lastflush = 0.0
+bakepool = None
 cellcolors = {0x00: (0, ( 7,  6,  3,  2,  8)),
               0x10: (0, (15, 14, 11, 10,  7)),
               0x20: (0, ( 8,  8,  8,  8,  8)),
@@ -92,12 +134,25 @@ ACTION_YESQUIT = 'User Response: Yes (Quit)'
 ALIGN_CENTER = 'Align Center'
 ALIGN_LEFT = 'Align Left'
 ALIGN_RIGHT = 'Align Right'
+ENCODECACHESIZE = 1024
+LAYOUTCACHESIZE = 256
+LAYOUTSTATECOUNT = 8
+FONTCATALOGSIG = 'G-SHE font catalog 1\r\n'
+#str.translate tables giving the high and low hex digit of each byte
+HEXHIGH = ''.join('0123456789ABCDEF'[i >> 4] for i in xrange(256))
+HEXLOW = ''.join('0123456789ABCDEF'[i & 15] for i in xrange(256))
+GLYPHCACHESIG = 'G-SHE glyph cache 2\r\n'
+SRCF2SIG = 'SRCF binary v2000\r\n'
 CTRL_BUTTON = 'Button Control'
 CTRL_HOTKEY = 'Hidden Control activated by hotkey'
 CTRL_LABEL = 'Control Label'
 CTRL_WINCLOSE = 'Hidden Control activated by window close request'
 LDIR_LEFT = 'Label Direction Left'
 LDIR_RIGHT = 'Label Direction Right'
+SDLX_CTRL_KEYS = (sdl2.SDLK_LCTRL,
+                  sdl2.SDLK_RCTRL,
+                  sdl2.SDLK_LCTRL | sdl2.SDLK_RCTRL,)
+SDLX_FRAMEEND = sdl2.SDL_USEREVENT | 0xF4E
 SDLX_KEYPRESS = sdl2.SDL_USEREVENT | sdl2.SDL_KEYUP | 0xF0
 SDLX_MOD_KEYS = (sdl2.SDLK_LCTRL,
                  sdl2.SDLK_LSHIFT,
@@ -107,6 +162,18 @@ SDLX_MOD_KEYS = (sdl2.SDLK_LCTRL,
                  sdl2.SDLK_RSHIFT,
                  sdl2.SDLK_RALT,
                  sdl2.SDLK_RGUI,)
+SDLX_NAV_KEYS = (sdl2.SDLK_TAB,
+                 sdl2.SDLK_UP,
+                 sdl2.SDLK_DOWN,
+                 sdl2.SDLK_LEFT,
+                 sdl2.SDLK_RIGHT,
+                 sdl2.SDLK_PAGEUP,
+                 sdl2.SDLK_PAGEDOWN,
+                 sdl2.SDLK_HOME,
+                 sdl2.SDLK_END,)
+SDLX_TASKDONE = sdl2.SDL_USEREVENT | 0x7AD
+SDLX_TASKPROGRESS = sdl2.SDL_USEREVENT | 0x7A9
+SDLX_TASKWAKE = sdl2.SDL_USEREVENT | 0x7A1
 SDLX_TIMERTICK = sdl2.SDL_USEREVENT | 0xC10
 
 
@@ -220,6 +287,15 @@ class Control(object):
             screen.refresh((self.spanc, self.spanr))
 
 
+class EncodeTable(dict):
+    def __init__(self, default):
+        #translate table giving default for characters not in it
+        self.default = default
+
+    def __missing__(self, key):
+        return self.default
+
+
 class Form(object):
     def __init__(self, controls, inittabidx=None):
         self.controls = controls
@@ -346,54 +422,300 @@ class Form(object):
         self.controls[self.tabidx].drawFocus()
 
 
+class GlyphBaker(object):
+    def __init__(self, fcw, fch, channels, cflags):
+        #channels holds the red, green, and blue subpixel coverage levels
+        #of all 256 glyphs, one byte per pixel per channel
+        self.glyphsize = fcw * fch
+        self.channels = channels
+        self.colorclass = [cflags[c] & 7 for c in xrange(256)]
+        self.pageof = [a if a in cellcolors else attalias[a]
+                       for a in xrange(256)]
+        #residency table: which glyphs of each page have been drawn
+        self.resident = {a: bytearray(256) for a in cellcolors}
+        self.tables = {}
+        if sys.byteorder == 'little':
+            self.chanpos = (2, 1, 0)
+        else:
+            self.chanpos = (1, 2, 3)
+
+    def bake(self, a, chars=None):
+        #draw the given characters (by default, all not yet drawn) into
+        #the glyph page for cell color a
+        resident = self.resident[a]
+        if chars is None:
+            chars = [c for c in xrange(256) if not resident[c]]
+        if len(chars) == 0:
+            return
+        gs = self.glyphsize
+        base = ctypes.addressof(fontmemory[a])
+        if len(chars) == 256:
+            page = self.drawpage(a)
+            ctypes.memmove(base, str(page), len(page))
+            resident[:] = '\x01' * 256
+            return
+        glyph = bytearray(gs << 2)
+        for c in chars:
+            p0 = gs * c
+            tables = self.glyphTables(a, self.colorclass[c])
+            for ch, t, pos in itertools.izip(self.channels, tables,
+                                             self.chanpos):
+                glyph[pos :: 4] = ch[p0 : p0 + gs].translate(t)
+            ctypes.memmove(base + (p0 << 2), str(glyph), len(glyph))
+            resident[c] = 1
+        return
+
+    def drawpage(self, a, page=None, offset=0):
+        #draw the whole glyph page for cell color a, in its most common
+        #color class and then with the characters of other classes redrawn,
+        #into page (a bytearray or mmap) at offset, or else into a new
+        #bytearray; return the page
+        gs = self.glyphsize
+        mainclass = collections.Counter(self.colorclass).most_common(1)[0][0]
+        if page is None:
+            page = bytearray(gs << 10)
+        end = offset + (gs << 10)
+        tables = self.glyphTables(a, mainclass)
+        for ch, t, pos in itertools.izip(self.channels, tables,
+                                         self.chanpos):
+            page[offset + pos : end : 4] = ch.translate(t)
+        glyph = bytearray(gs << 2)
+        for c in xrange(256):
+            if self.colorclass[c] == mainclass:
+                continue
+            p0 = gs * c
+            tables = self.glyphTables(a, self.colorclass[c])
+            for ch, t, pos in itertools.izip(self.channels, tables,
+                                             self.chanpos):
+                glyph[pos :: 4] = ch[p0 : p0 + gs].translate(t)
+            page[offset + (p0 << 2) : offset + ((p0 + gs) << 2)] = str(glyph)
+        return page
+
+    def ensure(self, pairs):
+        #draw any glyphs not yet drawn among the (attribute, character)
+        #pairs about to be shown on screen
+        missing = collections.defaultdict(list)
+        for a, c in pairs:
+            a = self.pageof[a]
+            if not self.resident[a][c]:
+                missing[a].append(c)
+        for a in missing:
+            self.bake(a, missing[a])
+
+    def glyphTables(self, a, colorclass):
+        key = (a, colorclass)
+        if key not in self.tables:
+            self.tables[key] = glyphtables(a, colorclass)
+        return self.tables[key]
+
+    def warm(self):
+        #draw the rest of one partly drawn page; return True once every
+        #page is complete
+        for a in sorted(cellcolors):
+            if 0 in self.resident[a]:
+                self.bake(a)
+                return False
+        return True
+
+
+class RowLayout(object):
+    def __init__(self, bytesperrow, group):
+        #the columns of a hex view row showing bytesperrow bytes: a
+        #10-digit offset, then the hex values with an extra space after
+        #every group bytes, then the bytes as characters
+        self.bytesperrow = bytesperrow
+        group = group if 0 < group < bytesperrow else bytesperrow
+        self.hexcols = [12 + 3 * j + j // group
+                        for j in xrange(bytesperrow)]
+        self.hexend = self.hexcols[-1] + 2
+        self.textstart = self.hexend + 2
+        self.width = self.textstart + bytesperrow + 2
+        #(start, end, attribute) of each part of the row
+        self.regions = ((0, 10, 0x20),
+                        (10, self.textstart, 0x00),
+                        (self.textstart, self.width, 0x10))
+
+    def format(self, data, offset, nrows, table):
+        #return nrows rows of self.width characters showing data, which
+        #starts at document offset offset, with its characters translated
+        #through table; each column of the layout is written for all the
+        #rows at once by an extended slice, so there is no loop over bytes
+        n = self.bytesperrow
+        w = self.width
+        out = bytearray(' ' * (w * nrows))
+        count = min(len(data), n * nrows)
+        if count == 0:
+            return out
+        used = (count + n - 1) // n
+        if len(data) != n * used:
+            data = data[: count] + '\0' * (n * used - count)
+        high = data.translate(HEXHIGH)
+        low = data.translate(HEXLOW)
+        text = data.translate(table)
+        end = w * used
+        for j, c in enumerate(self.hexcols):
+            out[c : end : w] = high[j : : n]
+            out[c + 1 : end : w] = low[j : : n]
+            out[self.textstart + j : end : w] = text[j : : n]
+        for r in xrange(used):
+            out[r * w : r * w + 10] = '{:010X}'.format(
+                (offset + r * n) & 0xFFFFFFFFFF)
+        if count < n * used:
+            #blank the padding after the end of data
+            last = (used - 1) * w
+            j = count - (used - 1) * n
+            out[last + self.hexcols[j] : last + self.hexend] = \
+                ' ' * (self.hexend - self.hexcols[j])
+            out[last + self.textstart + j : last + self.textstart + n] = \
+                ' ' * (n - j)
+        return out
+
+
+class SrcfPage(object):
+    def __init__(self, data, offset, length, flags, glyphbytes):
+        #a graphics page of an SRCF v2 file: a map of which of the 256
+        #glyphs are present, then glyphbytes coverage levels per glyph,
+        #left in data (e.g. a mmap) until used
+        self.data = data
+        self.offset = offset
+        self.length = length
+        self.flags = flags
+        self.glyphbytes = glyphbytes
+        self.page = None
+
+    def __getitem__(self, c):
+        #return a buffer holding the coverage levels of glyph c, or None
+        if self.page is None:
+            if self.flags & 1:
+                self.page = zlib.decompress(
+                    self.data[self.offset : self.offset + self.length])
+            else:
+                self.page = buffer(self.data, self.offset, self.length)
+        if self.page[c] == '\0':
+            return None
+        return buffer(self.page, 256 + self.glyphbytes * c, self.glyphbytes)
+
+
+FontInfo = collections.namedtuple('FontInfo',
+                                  ['name',
+                                   'author',
+                                   'license',
+                                   'cellwidth',
+                                   'cellheight',
+                                   'presets',
+                                   'defaultpreset',
+                                   'basesets',
+                                   'extsets'])
+FrameEvent = collections.namedtuple('FrameEvent',
+                                    ['type'])
 KeypressEvent = collections.namedtuple('KeypressEvent',
                                        ['type',
                                         'modkeys',
-                                        'keycombo'])
+                                        'keycombo',
+                                        'count'])
+TaskEvent = collections.namedtuple('TaskEvent',
+                                   ['type',
+                                    'name',
+                                    'value',
+                                    'error'])
 TimerEvent = collections.namedtuple('TimerEvent',
-                                       ['type',])
+                                       ['type',
+                                        'name'])
 
 
 def altencode(u, tenc):
-    global namedencodings
-    if isinstance(u, str):
-        u = u.decode('ascii', 'replace')
+    #encode u for display in target encoding tenc, which is a codec name
+    #or a list of the unicode characters shown by each byte; lists are
+    #keyed by identity, as in cachedtable, which keeps them alive once
+    #they have missed here, and their table is only needed on a miss
+    key = (u, tenc if isinstance(tenc, str) else id(tenc))
+    try:
+        b = encodecache.pop(key)
+    except KeyError:
+        if isinstance(u, str):
+            u = u.decode('ascii', 'replace')
+        b = None
+        if isinstance(tenc, str):
+            try:
+                b = u.encode(tenc, 'strict')
+            except UnicodeEncodeError:
+                pass
+        if b is None:
+            table = cachedtable(encodetables, tenc, encodetable)
+            b = u.translate(table).encode('latin-1')
+        if len(encodecache) >= ENCODECACHESIZE:
+            encodecache.popitem(False)
+    encodecache[key] = b
+    return b
+
+
+def bakepage(job):
+    #draw a whole glyph page in a bake pool worker: job is (file name,
+    #fcw, fch, attribute, page offset, coverage offset), where the file
+    #holds the glyph pages being loaded and, at coverage offset, the red,
+    #green, and blue coverage levels and then the color class of each
+    #glyph; the page is drawn straight into the file, and the attribute
+    #returned
+    filename, fcw, fch, a, offset, covoffset = job
+    glyphbytes = 256 * fcw * fch
+    with open(filename, 'r+b') as f:
+        m = mmap.mmap(f.fileno(), 0)
+    try:
+        channels = [m[covoffset + glyphbytes * k :
+                      covoffset + glyphbytes * (k + 1)] for k in xrange(3)]
+        classes = bytearray(m[covoffset + glyphbytes * 3 :
+                              covoffset + glyphbytes * 3 + 256])
+        GlyphBaker(fcw, fch, channels, classes).drawpage(a, m, offset)
+    finally:
+        m.close()
+    return a
+
+
+def cachedtable(cache, tenc, compile):
+    #return compile(tenc) for target encoding tenc, a codec name or a list,
+    #from cache; lists are looked up by identity rather than contents, so
+    #a hit costs the same for any list, and are kept in the cache so their
+    #ids stay unique; screen.encoding is replaced rather than changed in
+    #place when the font changes
+    key = tenc if isinstance(tenc, str) else id(tenc)
+    entry = cache.get(key)
+    if entry is None or entry[0] is not tenc:
+        entry = cache[key] = (tenc, compile(tenc))
+    return entry[1]
+
+
+def canceltask(name):
+    #stop the background task called name: a generator task is closed at
+    #once, and a worker thread sees False from its next progress call
+    for task in [task for task in tasks if task[0] == name]:
+        tasks.remove(task)
+        task[1].close()
+    if name in threadcancels:
+        threadcancels[name].set()
+
+
+def canceltimer(name):
+    #stop the timer called name, if it is set
+    timers.pop(name, None)
+
+
+def compiletexttable(tenc):
+    #compile target encoding tenc for RowLayout.format: a str.translate
+    #table showing each byte as itself where tenc shows a visible character
+    #for it, and as a dot otherwise
     if isinstance(tenc, str):
-        try:
-            return u.encode(tenc, 'strict')
-        except UnicodeEncodeError:
-            pass
         if tenc not in namedencodings:
             namedencodings[tenc] = [chr(c).decode(tenc, 'replace')
                                     for c in xrange(256)]
         tenc = namedencodings[tenc]
-    for f in fallbacks:
-        if f not in u:
-            continue
-        if f in tenc:
-            continue
-        for r in fallbacks[f]:
-            rq = True
-            for c in r:
-                if c not in tenc:
-                    rq = False
-                    break
-            if rq:
-                u = u.replace(f, r)
-                break
-    b = bytearray(itertools.repeat(0, len(u)))
-    p = 0
-    try:
-        rc = tenc.index(u'\ufffd')
-    except ValueError:
-        rc = 63
-    for c in u:
-        try:
-            b[p] = tenc.index(c)
-        except ValueError:
-            b[p] = rc
-        p += 1
-    return str(b)
+    dot = altencode(u'.', tenc)[: 1] or '.'
+    table = ''.join(
+        chr(i) if i < len(tenc) and isinstance(tenc[i], unicode)
+                  and len(tenc[i]) == 1 and tenc[i] != u'\ufffd'
+                  and unicodedata.category(tenc[i])[0] != 'C'
+        else dot
+        for i in xrange(256))
+    return table
 
 
 def countback(start=0x7fffffff):
@@ -412,10 +734,11 @@ def dlgloop(f, **kwargs):
             yield c.action
         if event.type == SDLX_KEYPRESS:
             if sdl2.SDLK_TAB in event.keycombo:
-                if event.modkeys & (sdl2.KMOD_LSHIFT | sdl2.KMOD_RSHIFT):
-                    f.focusPrev()
-                else:
-                    f.focusNext()
+                for i in xrange(event.count):
+                    if event.modkeys & (sdl2.KMOD_LSHIFT | sdl2.KMOD_RSHIFT):
+                        f.focusPrev()
+                    else:
+                        f.focusNext()
                 event.keycombo.discard(sdl2.SDLK_TAB)
             if sdl2.SDLK_RETURN in event.keycombo \
                  or sdl2.SDLK_SPACE in event.keycombo:
@@ -459,30 +782,403 @@ def drawdlg(spanc, spanr):
     return (area, ra, rc)
 
 
+def drawdocument(doc, top, status=None, left=0):
+    #show the bytes of doc from offset top: a title row, with status in
+    #place of the position if given, then a row for each view.rowbytes
+    #bytes with their offset, hex values, and characters, from column left
+    #of rows wider than the screen; only the bytes on screen are read from
+    #the document
+    rows = screen.NROWS - 1
+    ncols = screen.NCOLS
+    layout = rowlayout()
+    data = doc.read(top, rows * layout.bytesperrow)
+    name = os.path.basename(doc.filename)
+    if not isinstance(name, unicode):
+        name = name.decode(sys.getfilesystemencoding() or 'ascii',
+                           'replace')
+    title = altencode(u' ' + name, screen.encoding)
+    if status is not None:
+        position = altencode(u' ' + status + u' ', screen.encoding)
+    else:
+        position = ' {:X}/{:X} '.format(top, doc.size)
+    title = title[: ncols - len(position)]
+    screen.cbuf[ : , 0] = title \
+                          + ' ' * (ncols - len(title) - len(position)) \
+                          + position
+    screen.abuf[ : , 0] = 0x03
+    text = layout.format(data, top, rows, texttable(screen.encoding))
+    w = layout.width
+    if w == ncols and left == 0:
+        screen.cbuf[ : , 1 : ] = text
+    else:
+        screen.cbuf[ : , 1 : ] = ''.join(
+            str(text[r * w + left : (r + 1) * w]).ljust(ncols)[: ncols]
+            for r in xrange(rows))
+    if w - left < ncols:
+        screen.abuf[w - left : , 1 : ] = 0x00
+    for start, end, attribute in layout.regions:
+        start = max(start - left, 0)
+        end = min(end - left, ncols)
+        if start < end:
+            screen.abuf[start : end, 1 : ] = attribute
+    screen.refresh()
+
+
+def duetimers():
+    #return the names of timers whose deadlines have passed, in deadline
+    #order, rescheduling repeating timers and dropping one-shots
+    due = []
+    now = monotonic()
+    while len(timerheap) > 0 and timerheap[0][0] <= now:
+        deadline, seq, name = heappop(timerheap)
+        timer = timers.get(name)
+        if timer is None or timer[1] != seq:
+            #cancelled or reset since this entry was pushed
+            continue
+        due.append(name)
+        interval = timer[0]
+        if interval is None:
+            del timers[name]
+            continue
+        deadline += interval
+        if deadline <= now:
+            deadline = now + interval
+        timer[1] = next(timerseq)
+        heappush(timerheap, (deadline, timer[1], name))
+    return due
+
+
+def encodetable(tenc):
+    #compile target encoding tenc for altencode: a unicode.translate table
+    #mapping each character tenc can show, or else its first fallback that
+    #tenc can show, to the byte(s) showing it, and anything else to the
+    #byte showing u'\ufffd' (or '?')
+    if isinstance(tenc, str):
+        if tenc not in namedencodings:
+            namedencodings[tenc] = [chr(c).decode(tenc, 'replace')
+                                    for c in xrange(256)]
+        tenc = namedencodings[tenc]
+    direct = {}
+    for i, c in enumerate(tenc):
+        if isinstance(c, unicode) and len(c) == 1:
+            direct.setdefault(ord(c), unichr(i))
+    table = EncodeTable(direct.get(0xfffd, u'?'))
+    table.update(direct)
+    for f in fallbacks:
+        if ord(f) in direct:
+            continue
+        for r in fallbacks[f]:
+            if all(ord(c) in direct for c in r):
+                table[ord(f)] = u''.join(direct[ord(c)] for c in r)
+                break
+    return table
+
+
 def eventloop(**kwargs):
-    tenable = 'tinterval' in kwargs
-    if tenable:
-        lastt = time.clock()
-    while True:
-        events = sdl2.ext.get_events()
-        for event in events:
-            if event.type == sdl2.SDL_WINDOWEVENT:
-                if event.window.event == sdl2.SDL_WINDOWEVENT_EXPOSED:
-                    screen.refresh(((0, 0), (0, 0)))
+    #yield SDL events, due timers and background task progress, sleeping in
+    #SDL until the next event or timer deadline while no task is pending;
+    #each batch of pending SDL events is followed by an SDLX_FRAMEEND
+    #FrameEvent; in deferred present mode, flush the screen between
+    #batches, at most screen.maxfps times a second; with tinterval, also
+    #tick every tinterval seconds while the loop runs
+    tname = None
+    if 'tinterval' in kwargs:
+        tname = object()
+        settimer(tname, kwargs['tinterval'], kwargs['tinterval'])
+    global lastflush
+    try:
+        frametime = 1.0 / float(prefs['screen.maxfps'])
+    except (ValueError, ZeroDivisionError):
+        frametime = 0.0
+    try:
+        while True:
+            for name in duetimers():
+                yield TimerEvent(SDLX_TIMERTICK, name)
+            flushwait = None
+            if screen.needsflush():
+                flushwait = lastflush + frametime - monotonic()
+                if flushwait <= 0:
+                    screen.flush()
+                    lastflush = monotonic()
+                    flushwait = None
+            if len(tasks) > 0:
+                timeout = 0
+            elif len(timerheap) > 0:
+                timeout = max(int((timerheap[0][0] - monotonic()) * 1000) + 1,
+                              0)
+            else:
+                timeout = 1000
+            if flushwait is not None:
+                timeout = min(timeout, int(flushwait * 1000) + 1)
+            event = sdl2.SDL_Event()
+            if sdl2.SDL_WaitEventTimeout(ctypes.byref(event), timeout):
+                events = [event] + sdl2.ext.get_events()
+            else:
+                events = []
+            for event in events:
+                if event.type == sdl2.SDL_WINDOWEVENT:
+                    if event.window.event == sdl2.SDL_WINDOWEVENT_EXPOSED:
+                        screen.present()
+                        continue
+                elif event.type == SDLX_TASKWAKE:
+                    for taskevent in threadtaskevents():
+                        yield taskevent
                     continue
-            yield event
-        time.sleep(0.001)
-        t = time.clock()
-        if tenable and t > lastt + kwargs['tinterval']:
-            lastt = t
-            yield TimerEvent(SDLX_TIMERTICK)
+                yield event
+            if len(events) > 0:
+                yield FrameEvent(SDLX_FRAMEEND)
+            if len(tasks) > 0:
+                for taskevent in runtasks(len(events) == 0):
+                    yield taskevent
+    finally:
+        if tname is not None:
+            canceltimer(tname)
+
+
+def findfontfile(name):
+    #return the path of the cataloged font named name, or None
+    catalog = fontcatalog()
+    for path in sorted(catalog):
+        if catalog[path].name.lower() == name.lower():
+            return path
+    return None
+
+
+def findglyphcache(fonthash, sets):
+    #look up cached glyph pages for the font, preferring a coverage atlas
+    #for palette rendering (see loadglyphcache)
+    if prefs['font.render'] == 'palette':
+        cached = loadglyphcache(glyphcachekey(fonthash, sets, 'palette'))
+        if cached is not None:
+            return cached
+    return loadglyphcache(glyphcachekey(fonthash, sets))
+
+
+def fontcatalog(refresh=True):
+    #return {path: FontInfo} for the SRCF files in the font.dirs
+    #directories, as recorded in the catalog file font.catalog; with
+    #refresh, first rescan the directories, reading only files that are new
+    #or have changed size or mtime since they were cataloged
+    catalogname = prefs['font.catalog']
+    entries = {}
+    if catalogname:
+        try:
+            with open(catalogname, 'rb') as f:
+                if f.read(len(FONTCATALOGSIG)) == FONTCATALOGSIG:
+                    entries = pickle.load(f)
+        except Exception:
+            entries = {}
+    if refresh:
+        found = {}
+        changed = False
+        for d in prefs['font.dirs'].split(os.pathsep):
+            if len(d) == 0:
+                continue
+            d = os.path.abspath(os.path.expanduser(d))
+            try:
+                names = os.listdir(d)
+            except OSError:
+                continue
+            for name in names:
+                if not name.lower().endswith('.srcf'):
+                    continue
+                path = os.path.join(d, name)
+                try:
+                    st = os.stat(path)
+                except OSError:
+                    continue
+                entry = entries.get(path)
+                if entry is None or entry[: 2] != (st.st_size, st.st_mtime):
+                    #unreadable files are cataloged too, as None, so they
+                    #are not read again until they change
+                    try:
+                        with open(path, 'rb') as f:
+                            info = readfontinfo(f)
+                    except Exception:
+                        info = None
+                    if info is not None:
+                        info = tuple(info)
+                    entry = (st.st_size, st.st_mtime, info)
+                    changed = True
+                found[path] = entry
+        if changed or len(found) != len(entries):
+            entries = found
+            if catalogname:
+                tempname = catalogname + '.tmp'
+                try:
+                    with open(tempname, 'wb') as f:
+                        f.write(FONTCATALOGSIG)
+                        pickle.dump(entries, f, -1)
+                    os.rename(tempname, catalogname)
+                except (IOError, OSError):
+                    print 'Warning: failed to write font catalog'
+    return {path: FontInfo(*entries[path][2])
+            for path in entries
+            if entries[path][2] is not None}
+
+
+def glyphcachekey(fonthash, sets, render='baked'):
+    #hash everything the glyph pages depend on; coverage indices for
+    #palette rendering do not depend on colors
+    if render == 'palette':
+        return hashlib.sha1(repr((GLYPHCACHESIG,
+                                  fonthash,
+                                  sets,
+                                  render))).hexdigest()
+    return hashlib.sha1(repr((GLYPHCACHESIG,
+                              fonthash,
+                              sets,
+                              prefs['font.subpixel'],
+                              sorted(cellcolors.items()),
+                              ibmcolors,
+                              colormix,
+                              sys.byteorder))).hexdigest()
+
+
+def glyphtables(a, colorclass):
+    #return translate tables mapping glyph coverage levels (0-9) to the red,
+    #green, and blue levels of a character in the given color class drawn
+    #in cell color attribute a
+    try:
+        backcolor = ibmcolors[cellcolors[a][0]]
+    except IndexError:
+        backcolor = 0x00
+    try:
+        forecolor = ibmcolors[cellcolors[a][1][colorclass]]
+    except IndexError:
+        forecolor = 0x2a
+    tables = []
+    for shift in (4, 2, 0):
+        mix = colormix[(backcolor >> shift) & 3][(forecolor >> shift) & 3]
+        tables.append(''.join(chr(v) for v in mix) + chr(mix[9]) * 246)
+    return tables
+
+
+def installcoverage(fcw, fch, levels, source, offset=0):
+    #point the character surfaces of all 256 attributes at one shared atlas
+    #of fcw x fch glyphs held in source starting at offset, one byte per
+    #pixel indexing levels; each surface has its own palette, so colors
+    #are applied when glyphs are blitted
+    glyphbytes = 256 * fcw * fch
+    fontmemory.clear()
+    fontmemory['coverage'] = (ctypes.c_uint8 * glyphbytes).from_buffer(
+        source, offset)
+    fontmemory['levels'] = levels
+    newsurf = []
+    for a in xrange(256):
+        newsurf.append(sdl2.SDL_CreateRGBSurfaceFrom(
+            ctypes.byref(fontmemory['coverage']),
+            fcw, fch << 8,
+            8,
+            fcw,
+            0x0,
+            0x0,
+            0x0,
+            0x0))
+    replacecharsurfs(newsurf)
+    screen.cellwidth = fcw
+    screen.cellheight = fch
+    if screen.backend == 'numpy':
+        fontmemory['palettes'] = numpy.zeros((256, 256), numpy.uint32)
+        screen.setatlas(numpy.frombuffer(source, numpy.uint8, glyphbytes,
+                                         offset).reshape((256, fch, fcw)),
+                        palettes=fontmemory['palettes'])
+    setpalettes()
+
+
+def installfontpages(fcw, fch, source=None, offset=0):
+    #point fontmemory and the screen's character surfaces at glyph pages
+    #of fcw x fch cells for each cell color, mapped from source (e.g. a
+    #glyph cache file) starting at offset, or else from fresh anonymous
+    #memory, which the OS only commits as glyphs are drawn into it; for
+    #the numpy backend the pages are views into one glyph atlas
+    atlaspages = sorted(cellcolors)
+    pagesize = 256 * fcw * fch
+    if source is None:
+        source = mmap.mmap(-1, len(atlaspages) * pagesize << 2)
+        offset = 0
+    atlas = None
+    if screen.backend == 'numpy':
+        atlas = numpy.frombuffer(
+            source, numpy.uint32, len(atlaspages) * pagesize, offset
+            ).reshape((len(atlaspages), 256, fch, fcw))
+    fontmemory.clear()
+    newsurf = [None] * 256
+    for i, a in enumerate(atlaspages):
+        fontmemory[a] = (ctypes.c_uint32 * pagesize).from_buffer(
+            source, offset + (pagesize << 2) * i)
+        newsurf[a] = sdl2.SDL_CreateRGBSurfaceFrom(
+            ctypes.byref(fontmemory[a]),
+            fcw, fch << 8,
+            32,
+            fcw << 2,
+            0xff0000,
+            0xff00,
+            0xff,
+            0x0)
+    for a in xrange(256):
+        if a not in cellcolors:
+            newsurf[a] = newsurf[attalias[a]]
+    replacecharsurfs(newsurf)
+    screen.cellwidth = fcw
+    screen.cellheight = fch
+    if atlas is not None:
+        screen.setatlas(atlas,
+                        [atlaspages.index(a if a in cellcolors
+                                          else attalias[a])
+                         for a in xrange(256)])
+    return atlas
+
+
+def indexcoverage(coverage, classes, glyphsize):
+    #number the distinct (color class, subpixel coverage levels) of the
+    #pixels of all 256 glyphs, in sorted order; return the list of those
+    #combinations and the index of each pixel, or (None, None) if there
+    #are more than 256; the pixels are keyed in bulk, by NumPy if it is
+    #available, rather than one at a time
+    classbytes = ''.join(chr(classes[c]) * glyphsize for c in xrange(256))
+    if numpy is not None:
+        rgb = numpy.frombuffer(coverage, numpy.uint8).reshape(-1, 3) \
+                   .astype(numpy.uint32)
+        keys = (numpy.frombuffer(classbytes, numpy.uint8)
+                    .astype(numpy.uint32) << 24) \
+               | (rgb[ : , 0] << 16) | (rgb[ : , 1] << 8) | rgb[ : , 2]
+        distinct, inverse = numpy.unique(keys, return_inverse=True)
+        if len(distinct) > 256:
+            return (None, None)
+        levels = [(int(k) >> 24, struct.pack('>I', int(k))[1 :])
+                  for k in distinct]
+        return (levels, bytearray(inverse.astype(numpy.uint8).tostring()))
+    #pack each pixel's key into a 32-bit integer the same way
+    packed = bytearray(len(classbytes) * 4)
+    parts = (classbytes, coverage[0 : : 3], coverage[1 : : 3],
+             coverage[2 : : 3])
+    for i, part in enumerate(parts if sys.byteorder == 'big'
+                             else reversed(parts)):
+        packed[i : : 4] = part
+    keys = array.array('I', str(packed))
+    distinct = sorted(set(keys))
+    if len(distinct) > 256:
+        return (None, None)
+    indexof = dict((k, chr(i)) for i, k in enumerate(distinct))
+    levels = [(k >> 24, struct.pack('>I', k)[1 :]) for k in distinct]
+    return (levels, bytearray(''.join(map(indexof.__getitem__, keys))))
 
 
 def keypressfilter(events):
+    #yield events, adding KeypressEvents for key presses and combinations;
+    #repeated presses of one navigation key are held back until the end of
+    #the frame or another kind of event, and yielded as one with a count
     modstate = 0
     keycombo = set()
     armkeyup = False
+    pending = None
     for e in events:
+        if pending is not None and e.type not in (sdl2.SDL_KEYDOWN,
+                                                  sdl2.SDL_KEYUP,
+                                                  sdl2.SDL_TEXTINPUT):
+            yield pending
+            pending = None
         yield e
         if e.type == sdl2.SDL_KEYDOWN:
             armkeyup = True
@@ -491,51 +1187,206 @@ def keypressfilter(events):
             else:
                 if not modstate:
                     armkeyup = False
-                    yield KeypressEvent(SDLX_KEYPRESS,
-                                        0,
-                                        {e.key.keysym.sym})
+                    if pending is not None \
+                           and e.key.keysym.sym in pending.keycombo:
+                        pending = pending._replace(count=pending.count + 1)
+                    else:
+                        if pending is not None:
+                            yield pending
+                        pending = KeypressEvent(SDLX_KEYPRESS,
+                                                0,
+                                                {e.key.keysym.sym},
+                                                1)
+                    if e.key.keysym.sym not in SDLX_NAV_KEYS:
+                        yield pending
+                        pending = None
                 keycombo.add(e.key.keysym.sym)
         elif e.type == sdl2.SDL_KEYUP:
             if armkeyup:
                 armkeyup = False
+                if pending is not None:
+                    yield pending
+                    pending = None
                 yield KeypressEvent(SDLX_KEYPRESS,
                                     modstate,
-                                    keycombo)
+                                    keycombo,
+                                    1)
             if e.key.keysym.sym in SDLX_MOD_KEYS:
                 modstate &= ~e.key.keysym.sym
             else:
                 keycombo.discard(e.key.keysym.sym)
 
 
+def layouttext(text, maxw, maxh, breakchars):
+    #return the (begin, end) spans of text on each line of its cheapest
+    #layout in at most maxh lines of maxw characters, breaking at the
+    #(character, dropped) pairs in breakchars; if the text does not fit,
+    #lay out as much of it as can be reached.  The dynamic program is kept
+    #per geometry, and resumed from the last break candidate before the
+    #first character that differs from the previous text laid out
+    tlen = len(text)
+    skey = (maxw, maxh, breakchars)
+    state = layoutstates.pop(skey, None)
+    if state is None:
+        m = 1
+        nodes, begin, end, cost, lines, backtrace = \
+            [(0, 0)], [0], [0], [0], [0], [None]
+    else:
+        oldtext, nodes, begin, end, cost, lines, backtrace = state
+        if text.startswith(oldtext):
+            k = len(oldtext)
+        else:
+            #length of the common prefix, by bisection
+            k0 = 0
+            k1 = min(len(oldtext), tlen)
+            while k0 < k1:
+                k = (k0 + k1 + 1) >> 1
+                if text[k0 : k] == oldtext[k0 : k]:
+                    k0 = k
+                else:
+                    k1 = k - 1
+            k = k0
+        #keep the candidates before the last ordinary one ahead of index k,
+        #since everything about them depends only on text[: k]
+        m = bisect.bisect_left(nodes, (k, ))
+        while m > 1 and len(nodes[m - 1]) > 2:
+            m -= 1
+        m = max(m, 1)
+        for a in (nodes, begin, end, cost, lines, backtrace):
+            del a[m :]
+    #break candidates in text order, as (index, kind): kind 0 marks the
+    #start and end of the text, 1 a break that drops the character at
+    #index, and 2 a break after it; (index, 2, True) is an emergency break
+    #inside a word too long for a line
+    p0 = nodes[-1][0]
+    for idx in xrange(p0 + 1 if m > 1 else 0, tlen + 1):
+        if idx == tlen:
+            node = (tlen, 0)
+        elif (text[idx], True) in breakchars:
+            node = (idx, 1)
+        elif (text[idx], False) in breakchars:
+            node = (idx, 2)
+        else:
+            continue
+        if idx - p0 > maxw:
+            nodes.extend((e, 2, True) for e in xrange(p0 + 5, idx - 2))
+        nodes.append(node)
+        p0 = idx
+    #a line from n0 to n1 holds text[begin[n0] : end[n1]] and costs its
+    #squared slack plus one, plus breakpenalty if either end is an
+    #emergency break; find the cheapest run of at most maxh lines to each
+    #candidate from those within maxw characters before it
+    breakpenalty = maxw * maxw + maxw
+    for j in xrange(m, len(nodes)):
+        n = nodes[j]
+        begin.append(n[0] + 1)
+        end.append(n[0] + (1 if n[1] > 1 else 0))
+        best = None
+        bj = None
+        for i in xrange(bisect.bisect_left(begin, end[j] - maxw, 0, j), j):
+            if cost[i] is None or lines[i] >= maxh:
+                continue
+            c = cost[i] + (maxw - end[j] + begin[i]) ** 2 + 1
+            if len(nodes[i]) > 2 or len(n) > 2:
+                c += breakpenalty
+            #on ties prefer the cheapest, then earliest, predecessor
+            if best is None or (c, cost[i]) < best:
+                best = (c, cost[i])
+                bj = i
+        backtrace.append(bj)
+        if best is None:
+            cost.append(None)
+            lines.append(0)
+        else:
+            cost.append(best[0])
+            lines.append(lines[bj] + 1)
+    layoutstates[skey] = (text, nodes, begin, end, cost, lines, backtrace)
+    if len(layoutstates) > LAYOUTSTATECOUNT:
+        layoutstates.popitem(False)
+    goal = len(nodes) - 1
+    if cost[goal] is None:
+        #the text does not fit; show as much of it as can be reached
+        goal = 0
+        for j in xrange(1, len(nodes)):
+            if cost[j] is not None and \
+               (nodes[j][0], -cost[j]) > (nodes[goal][0], -cost[goal]):
+                goal = j
+    spans = []
+    j = goal
+    while backtrace[j] is not None:
+        i = backtrace[j]
+        spans.append((begin[i], end[j]))
+        j = i
+    spans.reverse()
+    return spans
+
+
 def loadfont(infilename=None, sets=None):
     global screen
+    global fontbaker
     global loadedfontpack
+    global loadedfonthash
     if infilename is False and loadedfontpack is not None:
         fdata = loadedfontpack
+        fonthash = loadedfonthash
+        cached = findglyphcache(fonthash, sets)
     else:
         if not isinstance(infilename, (str, unicode)):
             infilename = prefs['font.file']
+        if not os.path.isfile(infilename):
+            #maybe a font name rather than a file name
+            infilename = findfontfile(infilename) or infilename
         with open(infilename, 'rb') as f:
-            fdata = f.read(32)
-            #insert newer version read blocks here
-            if fdata.startswith('SRCF binary v1860\r\n'):
-                fdata = fdata[19 :] + f.read()
-                try:
-                    fdata = zlib.decompress(fdata)
-                except zlib.error:
-                    print 'Decompression error reading {:s}'.format(infilename)
-                    return
-                try:
-                    fdata = pickle.loads(fdata)
-                except Exception:
-                    print 'Error interpreting {:s}'.format(infilename)
-                    return
-                #perform transformation to newer version srcf data here
-            else:
-                print 'Signature check failed reading {:s}'.format(infilename)
+            try:
+                fdata = mmap.mmap(f.fileno(), 0, access=mmap.ACCESS_READ)
+            except (mmap.error, ValueError):
+                fdata = f.read()
+        fonthash = hashlib.sha1(fdata).hexdigest()
+        cached = findglyphcache(fonthash, sets)
+        if cached is not None:
+            loadedfontpack = None
+            loadedfonthash = None
+        #insert newer version read blocks here
+        elif fdata[: len(SRCF2SIG)] == SRCF2SIG:
+            try:
+                fdata = readsrcf2(fdata)
+            except Exception:
+                print 'Error interpreting {:s}'.format(infilename)
                 return
-        #assume fdata is in up-to-data srcf format
-        loadedfontpack = fdata
+        elif fdata[: 19] == 'SRCF binary v1860\r\n':
+            fdata = fdata[19 :]
+            try:
+                fdata = zlib.decompress(fdata)
+            except zlib.error:
+                print 'Decompression error reading {:s}'.format(infilename)
+                return
+            try:
+                fdata = pickle.loads(fdata)
+            except Exception:
+                print 'Error interpreting {:s}'.format(infilename)
+                return
+            #perform transformation to newer version srcf data here
+        else:
+            print 'Signature check failed reading {:s}'.format(infilename)
+            return
+        if cached is None:
+            #assume fdata is in up-to-data srcf format
+            loadedfontpack = fdata
+            loadedfonthash = fonthash
+    if cached is not None:
+        #glyph pages for these inputs are already on disk
+        fcw, fch, cucp, source, offset, levels = cached
+        screen.encoding = [unichr(c) for c in cucp]
+        if levels is None:
+            installfontpages(fcw, fch, source, offset)
+        else:
+            installcoverage(fcw, fch, levels, source, offset)
+        fontbaker = None
+        screen.glyphfn = None
+        screen.invalidate()
+        screen.refresh()
+        return
+    cachesets = sets
     rootdict, basesets, extsets, gpages = fdata
     del fdata
     #print rootdict
@@ -571,35 +1422,34 @@ def loadfont(infilename=None, sets=None):
     #begin drawing characters
     fcw = rootdict[0][3]
     fch = rootdict[0][4]
-    pagesize = 1024 * fcw * fch
-    #allocate font memory area and create surface objects if necessary
-    freesurf = []
-    freedsurfrepr = set()
-    for a in cellcolors:
-        if a not in fontmemory:
-            fontmemory[a] = (ctypes.c_ulong * pagesize)()
-            if screen.charsurf[a] is not None:
-                freesurf.append(screen.charsurf[a])
-            screen.charsurf[a] = sdl2.SDL_CreateRGBSurfaceFrom(
-                ctypes.byref(fontmemory[a]),
-                fcw, fch << 8,
-                32,
-                fcw << 2,
-                0xff0000,
-                0xff00,
-                0xff,
-                0x0)
-    for s in freesurf:
-        r = repr(s)
-        if r in freedsurfrepr:
-            continue
-        sdl2.SDL_FreeSurface(s)
-        freedsurfrepr.add(r)
-    del freesurf
-    del freedsurfrepr
-    for a in xrange(256):
-        if a not in cellcolors:
-            screen.charsurf[a] = screen.charsurf[attalias[a]]
+    #gather the coverage levels of all 256 glyphs, three subpixels to a
+    #pixel
+    glyphsize = fcw * fch
+    solid = chr(9) * (glyphsize * 3)
+    coverage = []
+    for c in xrange(256):
+        gp = gpages[gsrc[c]][c]
+        gp = '' if gp is None else buffer(gp)[: glyphsize * 3]
+        coverage.append(gp + solid[len(gp) :])
+    coverage = ''.join(coverage)
+    if prefs['font.render'] == 'palette':
+        #keep one byte per pixel, colored through palettes at blit time
+        levels, indices = indexcoverage(coverage,
+                                        [cflags[c] & 7 for c in xrange(256)],
+                                        glyphsize)
+        if levels is not None:
+            installcoverage(fcw, fch, levels, indices)
+            fontbaker = None
+            screen.glyphfn = None
+            try:
+                saveglyphcache(glyphcachekey(fonthash, cachesets, 'palette'),
+                               fcw, fch, cucp)
+            except (IOError, OSError):
+                print 'Warning: failed to write glyph cache'
+            screen.invalidate()
+            screen.refresh()
+            return
+        print 'Warning: too many coverage levels for palette rendering'
     if prefs['font.subpixel'] == 'rgb':
         offsetr = 0
         offsetg = 1
@@ -612,46 +1462,127 @@ def loadfont(infilename=None, sets=None):
         offsetr = 1
         offsetg = 1
         offsetb = 1
-    for c in xrange(256):
-        colorclass = cflags[c] & 7
-        gp = gpages[gsrc[c]][c]
-        for a in cellcolors:
-            try:
-                backcolor = ibmcolors[cellcolors[a][0]]
-            except IndexError:
-                backcolor = 0x00
+    #split the coverage levels into one string per subpixel channel; the
+    #baker colours glyphs by running those strings through per-channel
+    #translate tables
+    baker = GlyphBaker(fcw, fch,
+                       (coverage[offsetr :: 3],
+                        coverage[offsetg :: 3],
+                        coverage[offsetb :: 3]),
+                       cflags)
+    del coverage
+    shared = None
+    if prefs['font.bake'] == 'eager' and bakepool is not None:
+        #the bake workers were forked before SDL started, so they share
+        #none of its state, nor this font; the glyph pages go in a
+        #temporary file they can map, followed by the coverage levels and
+        #color class of each glyph, so no pixel data passes through the
+        #pool
+        shared = tempfile.NamedTemporaryFile(prefix='g-she-glyphs')
+        covoffset = len(cellcolors) * glyphsize << 10
+        shared.truncate(covoffset)
+        shared.seek(covoffset)
+        for ch in baker.channels:
+            shared.write(ch)
+        shared.write(''.join(chr(c) for c in baker.colorclass))
+        shared.flush()
+        installfontpages(fcw, fch, mmap.mmap(shared.fileno(), 0))
+    else:
+        installfontpages(fcw, fch)
+    fontbaker = baker
+    cachekey = glyphcachekey(fonthash, cachesets)
+    if prefs['font.bake'] == 'lazy':
+        #draw glyphs as the screen first needs them, and the rest of
+        #each page while the event loop is idle
+        def warmup():
+            while not baker.warm():
+                if fontbaker is not baker:
+                    return
+                yield None
+            screen.glyphfn = None
             try:
-                forecolor = ibmcolors[cellcolors[a][1][colorclass]]
-            except IndexError:
-                forecolor = 0x2a
-            backr = (backcolor & 0x30) >> 4
-            backg = (backcolor & 0xc) >> 2
-            backb = backcolor & 0x3
-            forer = (forecolor & 0x30) >> 4
-            foreg = (forecolor & 0xc) >> 2
-            foreb = forecolor & 0x3
-            aptr = 0
-            mptr = fcw * fch * c
-            for y in xrange(fch):
-                for x in xrange(fcw):
-                    try:
-                        r = colormix[backr][forer][gp[aptr + offsetr]]
-                        g = colormix[backg][foreg][gp[aptr + offsetg]]
-                        b = colormix[backb][foreb][gp[aptr + offsetb]]
-                    except IndexError:
-                        r = colormix[backr][forer][9]
-                        g = colormix[backg][foreg][9]
-                        b = colormix[backb][foreb][9]
-                    fontmemory[a][mptr] = r << 16 | g << 8 | b
-                    aptr += 3
-                    mptr += 1
-        yield None
-    screen.cellwidth = fcw
-    screen.cellheight = fch
+                saveglyphcache(cachekey, fcw, fch, cucp)
+            except (IOError, OSError):
+                print 'Warning: failed to write glyph cache'
+        screen.glyphfn = baker.ensure
+        starttask('glyphwarmup', warmup(), idle=True)
+    else:
+        if shared is not None:
+            jobs = [(shared.name, fcw, fch, a, (glyphsize << 10) * i,
+                     covoffset)
+                    for i, a in enumerate(sorted(cellcolors))]
+            for a in bakepool.imap_unordered(bakepage, jobs):
+                baker.resident[a][:] = '\x01' * 256
+                yield None
+            #the pages stay mapped once the file is gone
+            shared.close()
+        else:
+            for a in cellcolors:
+                baker.bake(a)
+                yield None
+        try:
+            saveglyphcache(cachekey, fcw, fch, cucp)
+        except (IOError, OSError):
+            print 'Warning: failed to write glyph cache'
+    screen.invalidate()
     screen.refresh()
 
+
+def loadglyphcache(key):
+    #return (fcw, fch, codepoints, mmap, page offset, coverage levels) for
+    #the glyph pages cached under key, or None if there are none; coverage
+    #levels is None for baked pages
+    cachedir = prefs['font.cachedir']
+    if not cachedir:
+        return None
+    filename = os.path.join(cachedir, key + '.glyphs')
+    try:
+        with open(filename, 'rb') as f:
+            head = f.read(len(GLYPHCACHESIG) + 4)
+            if not head.startswith(GLYPHCACHESIG):
+                return None
+            metalen, = struct.unpack('<I', head[len(GLYPHCACHESIG) :])
+            fcw, fch, cucp, atlaspages, offset, levels = pickle.loads(
+                f.read(metalen))
+            if levels is not None:
+                size = offset + (fcw * fch << 8)
+            elif atlaspages == sorted(cellcolors):
+                size = offset + len(atlaspages) * (fcw * fch << 10)
+            else:
+                return None
+            if os.fstat(f.fileno()).st_size != size:
+                return None
+            source = mmap.mmap(f.fileno(), size, access=mmap.ACCESS_COPY)
+        os.utime(filename, None)
+    except Exception:
+        return None
+    return (fcw, fch, cucp, source, offset, levels)
+
+
 def loadprefs(infilename=None):
     global prefs
+    prefs.update({
+        'font.file': 'temoro.srcf',
+        'font.sets': '(default)',
+        'font.subpixel': 'rgb',
+        'font.encoding': 'ascii',
+        'font.render': 'palette',
+        'font.bake': 'lazy',
+        'font.bakeprocs': '0',
+        'font.cachedir': os.path.join(os.path.expanduser('~'),
+                                      '.g-she-cache'),
+        'font.cachesize': str(32 << 20),
+        'font.dirs': os.curdir,
+        'font.catalog': os.path.join(os.path.expanduser('~'),
+                                     '.g-she-fonts'),
+        'edit.undomemory': str(4 << 20),
+        'screen.backend': 'blit',
+        'screen.maxfps': '60',
+        'screen.present': 'deferred',
+        'tasks.framebudget': '8',
+        'view.group': '8',
+        'view.rowbytes': '16',
+        })
     if infilename is None:
         infilename = os.path.join(
             os.path.expanduser('~'),
@@ -667,18 +1598,15 @@ def loadprefs(infilename=None):
                 prefs[k] = v
         return None
     except IOError:
-        prefs.update({
-            'font.file': 'temoro.srcf',
-            'font.sets': '(default)',
-            'font.subpixel': 'rgb',
-            'font.encoding': 'ascii',
-            })
         return None
 
 
 def main():
+    global bakepool
     global fontmemory
+    global fontbaker
     global loadedfontpack
+    global loadedfonthash
     global prefs
     global screen
     global window
@@ -690,6 +1618,17 @@ def main():
     print '\nLoading user preferences...'
     prefs = {}
     loadprefs()
+    if prefs['font.bake'] == 'eager' and prefs['font.render'] != 'palette' \
+           and hasattr(os, 'fork'):
+        #fork the bake workers now, while there is no SDL state for them
+        #to inherit
+        try:
+            procs = (int(prefs['font.bakeprocs'])
+                     or multiprocessing.cpu_count())
+        except (ValueError, NotImplementedError):
+            procs = 1
+        if procs > 1:
+            bakepool = multiprocessing.Pool(min(procs, len(cellcolors)))
     print 'Initializing SDL...'
     sdl2.ext.init()
     print 'Initializing screen buffer...'
@@ -703,7 +1642,10 @@ def main():
                            charcells,
                            10, 24,
                            window.refresh,
-                           ())
+                           (),
+                           scrbuf.rectrefresher(window.window),
+                           prefs['screen.backend'])
+    screen.deferpresent = prefs['screen.present'] == 'deferred'
     screen.encoding = prefs['font.encoding']
     if ' ' in screen.encoding:
         try:
@@ -748,18 +1690,40 @@ def main():
     screen.refresh()
     print 'Loading font...'
     fontmemory = {}
+    fontbaker = None
     loadedfontpack = None
-    lastrefresh = time.clock()
-    for discard in loadfont():
-        if time.clock() - lastrefresh > 1.0:
+    loadedfonthash = None
+    lastrefresh = monotonic()
+    starttask('loadfont', loadfont())
+    for event in eventloop():
+        if event.type == SDLX_TASKDONE and event.name == 'loadfont':
+            break
+        if monotonic() - lastrefresh > 1.0:
+            screen.invalidate()
             screen.refresh()
-            lastrefresh = time.clock()
+            lastrefresh = monotonic()
+    doc = None
+    if len(sys.argv) > 1:
+        print 'Opening {:s}...'.format(sys.argv[1])
+        try:
+            doc = document.Document(sys.argv[1], True,
+                                    int(prefs['edit.undomemory']))
+        except (IOError, OSError, mmap.error, ValueError):
+            print 'Error: failed to open {:s}'.format(sys.argv[1])
     print 'Starting application loop...'
-    scnWrapdemo()
-    for event in eventloop():
-        if event.type == sdl2.SDL_QUIT:
-            if scnQuitconfirm() is ACTION_YESQUIT:
-                break
+    if doc is not None:
+        scnDocument(doc)
+        doc.close()
+    else:
+        scnWrapdemo()
+        for event in eventloop():
+            if event.type == sdl2.SDL_QUIT:
+                if scnQuitconfirm() is ACTION_YESQUIT:
+                    break
+    if bakepool is not None:
+        bakepool.close()
+        bakepool.join()
+        bakepool = None
     print 'Quitting SDL...'
     window.hide()
     del window
@@ -770,6 +1734,276 @@ def main():
     return 0
 
 
+def monotonic():
+    #seconds from SDL's monotonic high resolution counter
+    return sdl2.SDL_GetPerformanceCounter() / perfrequency
+
+
+def pruneglyphcache(keep=None):
+    #delete least recently used glyph cache files (other than keep) until
+    #the cache fits in font.cachesize bytes
+    cachedir = prefs['font.cachedir']
+    try:
+        limit = int(prefs['font.cachesize'])
+    except ValueError:
+        return
+    files = []
+    for name in os.listdir(cachedir):
+        if not name.endswith('.glyphs'):
+            continue
+        st = os.stat(os.path.join(cachedir, name))
+        files.append((name == keep, st.st_mtime, st.st_size, name))
+    files.sort()
+    total = sum(f[2] for f in files)
+    for iskeep, mtime, size, name in files:
+        if total <= limit or iskeep:
+            break
+        os.remove(os.path.join(cachedir, name))
+        total -= size
+
+
+def replacecharsurfs(newsurf):
+    #give the screen a new list of 256 character surfaces, freeing the ones
+    #they replace (attributes may share a surface)
+    freedsurfrepr = set(repr(s) for s in newsurf)
+    for s in screen.charsurf:
+        if s is None:
+            continue
+        r = repr(s)
+        if r in freedsurfrepr:
+            continue
+        sdl2.SDL_FreeSurface(s)
+        freedsurfrepr.add(r)
+    del freedsurfrepr
+    screen.charsurf[:] = newsurf
+
+
+def readfontinfo(f):
+    #return the FontInfo of an open SRCF file, or None if it is not one;
+    #only the metadata block of a v2 file is read
+    buf = f.read(len(SRCF2SIG) + 21)
+    #insert newer signature check blocks here
+    if buf.startswith(SRCF2SIG):
+        metaoffset, metalen = struct.unpack_from('<II', buf,
+                                                 len(SRCF2SIG) + 5)
+        f.seek(metaoffset)
+        rootdict, basesets, extsets = readsrcf2meta(f.read(metalen))
+    elif buf.startswith('SRCF binary v1860\r\n'):
+        rootdict, basesets, extsets, gpages = pickle.loads(
+            zlib.decompress(buf[19 :] + f.read()))
+        del gpages
+    else:
+        return None
+    return FontInfo(*(rootdict[0][: 7]
+                      + ({k: basesets[k][0][0] for k in basesets},
+                         {k: extsets[k][0][0] for k in extsets})))
+
+
+def readsrcf2(data):
+    #return (rootdict, basesets, extsets, gpages) from SRCF v2 data; the
+    #glyph pages are only read from data as they are used
+    fcw, fch, metaoffset, metalen, tocoffset, toccount = struct.unpack_from(
+        '<xHHIIII', data, len(SRCF2SIG))
+    rootdict, basesets, extsets = readsrcf2meta(
+        data[metaoffset : metaoffset + metalen])
+    gpages = {}
+    p = tocoffset
+    for i in xrange(toccount):
+        offset, length, flags, namelen = struct.unpack_from('<IIIH', data, p)
+        p += 14
+        gpages[data[p : p + namelen].decode('utf8')] = SrcfPage(
+            data, offset, length, flags, fcw * 3 * fch)
+        p += namelen
+    return (rootdict, basesets, extsets, gpages)
+
+
+def readsrcf2meta(meta):
+    #return (rootdict, basesets, extsets) from an SRCF v2 metadata block,
+    #skipping the name, author, and license strings that lead it
+    p = 0
+    for i in xrange(3):
+        slen, = struct.unpack_from('<H', meta, p)
+        p += 2 + slen
+    return pickle.loads(meta[p :])
+
+
+def rowlayout():
+    #the RowLayout for the view.rowbytes and view.group preferences
+    key = (max(int(prefs['view.rowbytes']), 1), int(prefs['view.group']))
+    layout = rowlayouts.get(key)
+    if layout is None:
+        layout = rowlayouts[key] = RowLayout(*key)
+    return layout
+
+
+def runtasks(idle):
+    #step the pending generator tasks round robin until the frame budget
+    #is spent, each at least once; idle only tasks are stepped only when
+    #idle is true; return TaskEvents for the latest progress of each task
+    #stepped, then for each task that finished
+    deadline = monotonic() + float(prefs['tasks.framebudget']) / 1000
+    stepped = collections.OrderedDict()
+    finished = []
+    while True:
+        runnable = [task for task in tasks if idle or not task[2]]
+        if len(runnable) == 0:
+            break
+        for task in runnable:
+            try:
+                task[3] = next(task[1])
+            except StopIteration:
+                tasks.remove(task)
+                finished.append(TaskEvent(SDLX_TASKDONE,
+                                          task[0], task[3], None))
+                taskresults[task[0]] = finished[-1]
+            except Exception as e:
+                tasks.remove(task)
+                finished.append(TaskEvent(SDLX_TASKDONE,
+                                          task[0], task[3], e))
+                taskresults[task[0]] = finished[-1]
+            else:
+                stepped[task[0]] = task[3]
+        if monotonic() >= deadline:
+            break
+    return ([TaskEvent(SDLX_TASKPROGRESS, name, value, None)
+             for name, value in stepped.iteritems()
+             if name not in [event.name for event in finished]]
+            + finished)
+
+
+def saveglyphcache(key, fcw, fch, cucp):
+    #write the glyph pages (or coverage atlas) now in fontmemory to the
+    #cache under key
+    cachedir = prefs['font.cachedir']
+    if not cachedir:
+        return
+    if not os.path.isdir(cachedir):
+        os.makedirs(cachedir)
+    levels = fontmemory.get('levels')
+    if levels is None:
+        atlaspages = sorted(cellcolors)
+        pagebytes = fcw * fch << 10
+    else:
+        atlaspages = ['coverage']
+        pagebytes = fcw * fch << 8
+    if len(atlaspages) * pagebytes > int(prefs['font.cachesize']):
+        return
+    headlen = len(GLYPHCACHESIG) + 4
+    meta = pickle.dumps((fcw, fch, list(cucp), atlaspages, 0, levels), -1)
+    #start the pages on a 4 KiB boundary
+    offset = (headlen + len(meta) + 64 + 4095) & ~4095
+    meta = pickle.dumps((fcw, fch, list(cucp), atlaspages, offset, levels),
+                        -1)
+    filename = os.path.join(cachedir, key + '.glyphs')
+    tempname = filename + '.tmp'
+    with open(tempname, 'wb') as f:
+        f.write(GLYPHCACHESIG)
+        f.write(struct.pack('<I', len(meta)))
+        f.write(meta)
+        f.write('\0' * (offset - headlen - len(meta)))
+        for a in atlaspages:
+            f.write(ctypes.string_at(fontmemory[a], pagebytes))
+    os.rename(tempname, filename)
+    pruneglyphcache(key + '.glyphs')
+
+
+def scnDocument(doc):
+    #browse doc until the user confirms quitting, scrolling rows wider than
+    #the screen with Left and Right; Ctrl+S saves it in the background,
+    #showing progress in the title row, and Esc cancels that
+    restoretitle = window.title
+    window.title = os.path.basename(doc.filename)
+    rows = screen.NROWS - 1
+    n = rowlayout().bytesperrow
+    lasttop = max((doc.size + n - 1) // n - rows, 0) * n
+    lastleft = max(rowlayout().width - screen.NCOLS, 0)
+    top = 0
+    left = 0
+    status = None
+    saving = None
+    drawdocument(doc, top)
+    for event in keypressfilter(eventloop()):
+        if event.type == sdl2.SDL_QUIT:
+            if scnQuitconfirm() is ACTION_YESQUIT:
+                break
+            continue
+        result = taskresult('save') if saving is not None else None
+        if result is not None:
+            #collected here rather than from its event, which a dialog
+            #open at the time would have taken
+            saving = None
+            if result.error is not None:
+                status = u'Save failed: {:s}'.format(
+                    getattr(result.error, 'strerror', None)
+                    or str(result.error))
+            elif result.value is None:
+                status = u'Save cancelled'
+            else:
+                status = u'Saved'
+                if doc.pendingfile is not None:
+                    try:
+                        doc.reopen()
+                    except (IOError, OSError, mmap.error, ValueError) as e:
+                        status = u'Saved, but reopening failed: {:s}' \
+                                 .format(getattr(e, 'strerror', None)
+                                         or str(e))
+            drawdocument(doc, top, status, left)
+        if event.type == SDLX_TASKPROGRESS and event.name == 'save' \
+               and saving is not None:
+            done, total = event.value
+            status = u'Saving {:d}%'.format(done * 100 // max(total, 1))
+            drawdocument(doc, top, status, left)
+            continue
+        if event.type != SDLX_KEYPRESS:
+            continue
+        if event.modkeys in SDLX_CTRL_KEYS \
+               and sdl2.SDLK_s in event.keycombo and saving is None:
+            status = u'Saving'
+            #the save thread leaves remapping the document to this one,
+            #which reads it in between
+            saving = startthread('save', lambda progress: doc.save(
+                lambda done, total: progress((done, total)), False))
+            drawdocument(doc, top, status, left)
+            continue
+        if event.modkeys:
+            continue
+        if sdl2.SDLK_ESCAPE in event.keycombo and saving is not None:
+            canceltask('save')
+            continue
+        newtop = top
+        newleft = left
+        if sdl2.SDLK_DOWN in event.keycombo:
+            newtop += n * event.count
+        elif sdl2.SDLK_UP in event.keycombo:
+            newtop -= n * event.count
+        elif sdl2.SDLK_PAGEDOWN in event.keycombo:
+            newtop += n * rows * event.count
+        elif sdl2.SDLK_PAGEUP in event.keycombo:
+            newtop -= n * rows * event.count
+        elif sdl2.SDLK_HOME in event.keycombo:
+            newtop = 0
+        elif sdl2.SDLK_END in event.keycombo:
+            newtop = lasttop
+        elif sdl2.SDLK_RIGHT in event.keycombo:
+            newleft += 8 * event.count
+        elif sdl2.SDLK_LEFT in event.keycombo:
+            newleft -= 8 * event.count
+        newtop = max(min(newtop, lasttop), 0)
+        newleft = max(min(newleft, lastleft), 0)
+        if (newtop, newleft) != (top, left):
+            top = newtop
+            left = newleft
+            if saving is None:
+                status = None
+            drawdocument(doc, top, status, left)
+    if saving is not None:
+        #leave the file as it was rather than closing the document under
+        #the save
+        canceltask('save')
+        saving.join()
+    window.title = restoretitle
+
+
 def scnQuitconfirm(*args):
     restoreinfo = drawdlg((21, 59), (10, 15))
     wraptext('Exit G-SHE?',
@@ -826,9 +2060,69 @@ def scnWrapdemo(*args):
     screen.refresh()
 
 
+def settimer(name, delay, interval=None):
+    #(re)set the timer called name to tick delay seconds from now, then
+    #every interval seconds if interval is given
+    seq = next(timerseq)
+    timers[name] = [interval, seq]
+    heappush(timerheap, (monotonic() + delay, seq, name))
+
+
+def setpalettes():
+    #color the glyph surfaces of every attribute from the coverage levels
+    #of the loaded font; this is cheap, so it can follow any change to
+    #cellcolors or font.subpixel
+    levels = fontmemory['levels']
+    if prefs['font.subpixel'] == 'rgb':
+        order = (0, 1, 2)
+    elif prefs['font.subpixel'] == 'bgr':
+        order = (2, 1, 0)
+    else:
+        order = (1, 1, 1)
+    #the coverage level of each palette entry in each channel, and the runs
+    #of entries sharing a color class (indexcoverage sorts them by class),
+    #so each run is colored by translating one string per channel
+    channels = [''.join(cov[k] for colorclass, cov in levels) for k in order]
+    runs = []
+    start = 0
+    for colorclass, run in itertools.groupby(levels, lambda l: l[0]):
+        end = start + len(list(run))
+        runs.append((colorclass, start, end))
+        start = end
+    palettes = {}
+    for a in xrange(256):
+        ca = a if a in cellcolors else attalias[a]
+        if ca not in palettes:
+            #SDL_Color entries: red, green, blue, and opaque alpha
+            colors = bytearray(1024)
+            colors[3 : 4 * len(levels) : 4] = '\xff' * len(levels)
+            for colorclass, start, end in runs:
+                tables = glyphtables(ca, colorclass)
+                for k in xrange(3):
+                    colors[4 * start + k : 4 * end : 4] = \
+                        channels[k][start : end].translate(tables[k])
+            row = None
+            if 'palettes' in fontmemory:
+                rgb = numpy.frombuffer(colors, numpy.uint8).reshape(256, 4) \
+                           .astype(numpy.uint32)
+                row = (rgb[ : , 0] << 16) | (rgb[ : , 1] << 8) | rgb[ : , 2]
+            palettes[ca] = ((sdl2.SDL_Color * 256).from_buffer(colors), row)
+        pal, row = palettes[ca]
+        sdl2.SDL_SetPaletteColors(screen.charsurf[a].contents.format.contents
+                                  .palette, pal, 0, 256)
+        if row is not None:
+            fontmemory['palettes'][a] = row
+
+
 def srcfnamefromfile(f):
     buf = f.read(32)
     #insert newer signature check blocks here
+    if buf.startswith(SRCF2SIG):
+        buf += f.read(40 - len(buf))
+        metaoffset, = struct.unpack_from('<I', buf, len(SRCF2SIG) + 5)
+        f.seek(metaoffset)
+        nlen, = struct.unpack('<H', f.read(2))
+        return f.read(nlen).decode('utf8', 'replace')
     if buf.startswith('SRCF binary v1860\r\n'):
         buf = buf[19 :]
         sidx = -1
@@ -843,6 +2137,77 @@ def srcfnamefromfile(f):
         return buf[sidx : sidx + nlen].decode('utf8', 'replace')
 
 
+def starttask(name, gen, idle=False):
+    #run generator gen as a background task called name: the event loop
+    #steps it within its frame budget, or only while no events are
+    #pending if idle is true, and yields TaskEvents with each value it
+    #yields and when it finishes
+    taskresults.pop(name, None)
+    tasks.append([name, gen, idle, None])
+
+
+def startthread(name, fn, *args):
+    #run fn(progress, *args) as a background task called name in a worker
+    #thread; fn reports with progress(value), which returns False once the
+    #task is cancelled, and the event loop yields TaskEvents with each
+    #report and with the result or exception when fn returns
+    cancelled = threading.Event()
+    threadcancels[name] = cancelled
+    taskresults.pop(name, None)
+    def progress(value):
+        threadevents.put(TaskEvent(SDLX_TASKPROGRESS, name, value, None))
+        wakeeventloop()
+        return not cancelled.is_set()
+    def run():
+        try:
+            result = fn(progress, *args)
+        except Exception as e:
+            threadevents.put(TaskEvent(SDLX_TASKDONE, name, None, e))
+        else:
+            threadevents.put(TaskEvent(SDLX_TASKDONE, name, result, None))
+        wakeeventloop()
+    thread = threading.Thread(target=run, name=str(name))
+    thread.daemon = True
+    thread.start()
+    return thread
+
+
+def taskresult(name):
+    #remove and return the SDLX_TASKDONE TaskEvent with which the
+    #background task called name finished, or None if it is still running
+    #or has already been asked for; unlike the event itself, which goes to
+    #whichever loop is running at the time, e.g. a dialog's, this waits
+    #for the code that started the task
+    return taskresults.pop(name, None)
+
+
+def texttable(tenc):
+    #the text column table for target encoding tenc, compiled once
+    return cachedtable(texttables, tenc, compiletexttable)
+
+
+def threadtaskevents():
+    #return the TaskEvents posted by worker threads since the last call,
+    #keeping only the latest progress of each task
+    threadwake.clear()
+    progress = collections.OrderedDict()
+    finished = []
+    while True:
+        try:
+            event = threadevents.get_nowait()
+        except Queue.Empty:
+            break
+        if event.type == SDLX_TASKDONE:
+            progress.pop(event.name, None)
+            if threadcancels.get(event.name) is not None:
+                del threadcancels[event.name]
+            finished.append(event)
+            taskresults[event.name] = event
+        else:
+            progress[event.name] = event
+    return progress.values() + finished
+
+
 def undrawdlg(restoreinfo):
     area, abuf, cbuf = restoreinfo
     screen.abuf[area] = abuf
@@ -850,6 +2215,16 @@ def undrawdlg(restoreinfo):
     screen.refresh(area)
 
 
+def wakeeventloop():
+    #from any thread, push an SDLX_TASKWAKE event so the event loop
+    #collects the worker threads' TaskEvents, unless one is already pending
+    if not threadwake.is_set():
+        threadwake.set()
+        event = sdl2.SDL_Event()
+        event.type = SDLX_TASKWAKE
+        sdl2.SDL_PushEvent(ctypes.byref(event))
+
+
 def wraptext(text, spanc, spanr, alignment=None, breakchars=None):
     if alignment is None:
         alignment = ALIGN_LEFT
@@ -877,127 +2252,44 @@ def wraptext(text, spanc, spanr, alignment=None, breakchars=None):
         breakchars = {(c if isinstance(c, tuple)
                        else (c, True))
                       for c in breakchars}
+    breakchars = frozenset(breakchars)
     padchar = altencode(u' ', screen.encoding)
-    q = []
-    tlen = len(text)
-    h = lambda x: (tlen - x) // maxw
-    ll = lambda n0, n1: (n1[0] - n0[0]
-                         + (1 if n0[1] < 1 else 0)
-                         - (1 if n1[1] <= 1 else 0))
-    d = lambda n0, n1: (maxw - ll(n0, n1)) ** 2 + 1
-    breakpenalty = maxw * maxw + maxw
-    ec = countback()
-    start = [h(0), (0, 0), next(ec), 0x7fffffff, h(0), [], 0]
-    q.append(start)
-    ebc = []
-    for idx in xrange(len(text)):
-        c = text[idx]
-        if (c, True) in breakchars:
-            q.append([0x7fffffff, (idx, 1), None, 0x7fffffff, h(idx), [], None])
-        elif (c, False) in breakchars:
-            q.append([0x7fffffff, (idx, 2), None, 0x7fffffff, h(idx), [], None])
-        else:
-            ebc.append([0x7fffffff, (idx, 2, True), None, 0x7fffffff, h(idx), [], None])
-    b0 = q[0]
-    eb = []
-    for b1 in itertools.islice(q, 1, None):
-        idx0 = b0[1][0] + (1 if b0[1] >= 1 else 0)
-        idx1 = b1[1][0] + (1 if b1[1] > 1 else 0)
-        if idx1 - idx0 > maxw:
-            print idx0, idx1
-            for b2 in ebc:
-                if idx0 + 3 < b2[1][0] < idx1 - 3:
-                    eb.append(b2)
-        b0 = b1
-    del ebc
-    q += eb
-    del eb
-    goal = [0x7fffffff, (tlen, 0), next(ec), 0x7fffffff, 0, [], None]
-    q.append(goal)
-    backtrace = {}
-    for i in xrange(len(q) - 1):
-        for j in xrange(i + 1, len(q)):
-            n0 = q[i][1]
-            n1 = q[j][1]
-            if ll(n0, n1) <= maxw:
-                if len(n0) > 2 or len(n1) > 2:
-                    q[i][5].append((q[j], d(n0, n1) + breakpenalty))
-                else:
-                    q[i][5].append((q[j], d(n0, n1)))
-##    for i in q:
-##        if len(i[1]) <= 2:
-##            print i[0], i[1], i[2], i[3], i[4], '; '.join(
-##                '({:d}, {:d})'.format(j[0][1][0], j[1])
-##                for j in i[5]
-##                if len(j[0][1]) <= 2)
-    heapify(q)
-    searching = True
-    while len(q) > 0 and searching:
-        cnode = heappop(q)
-        if cnode is goal:
-            searching = False
-            break
-        if cnode[2] is None:
-            continue
-        lc1 = cnode[6] + 1
-        if lc1 > maxh:
-            continue
-        cnode[2] = None
-        g0 = cnode[0]
-        for edge in cnode[5]:
-            g1 = g0 + edge[1]
-            g1h = g1 + edge[0][4]
-            if g1 < edge[0][0]:
-                backtrace[edge[0][1]] = cnode[1]
-                edge[0][0] = g1
-                edge[0][3] = g1h
-                edge[0][6] = lc1
-                if edge[0][2] is None:
-                    edge[0][2] = next(ec)
-                    q.append(edge[0])
-                heapify(q)
-    if goal[6] is None:
-        bestscore = (0, -0x80000000)
-        bestreach = start
-        for e in q:
-            escore = (e[1][0], e[0] ^ -1)
-            if escore > bestscore:
-                bestscore = escore
-                bestreach = e
-        goal = bestreach
-    tnode = goal[1]
-    linebreaks = [tnode]
-    while tnode != start[1]:
-        tnode = backtrace[tnode]
-        linebreaks.append(tnode)
-    linebreaks.reverse()
-    b0 = linebreaks[0]
-    trimset = ''.join(c[0]
-                      for c in breakchars
-                      if c[1])
+    key = (text, maxw, maxh, alignment, breakchars, padchar)
+    try:
+        rows, ccol = layoutcache.pop(key)
+    except KeyError:
+        trimset = ''.join(c[0]
+                          for c in breakchars
+                          if c[1])
+        rows = []
+        ccol = None
+        for idx0, idx1 in layouttext(text, maxw, maxh, breakchars)[: maxh]:
+            line = text[idx0 : idx1].strip(trimset)
+            excess = maxw - len(line)
+            #if alignment is ALIGN_LEFT: #see else suite
+            if alignment is ALIGN_CENTER:
+                padl = excess >> 1
+                padr = excess - padl
+            elif alignment is ALIGN_RIGHT:
+                padl = excess
+                padr = 0
+            else: #ALIGN_LEFT or unknown
+                padl = 0
+                padr = excess
+            rows.append(padchar * padl + line + padchar * padr)
+            ccol = maxw - padr
+        if len(layoutcache) >= LAYOUTCACHESIZE:
+            layoutcache.popitem(False)
+    layoutcache[key] = (rows, ccol)
+    #only write rows that differ from what the screen already shows
     r = y0
-    for b1 in itertools.islice(linebreaks, 1, None):
-        idx0 = b0[0] + (1 if b0[1] >= 1 else 0)
-        idx1 = b1[0] + (1 if b1[1] > 1 else 0)
-        line = text[idx0 : idx1].strip(trimset)
-        excess = maxw - len(line)
-        #if alignment is ALIGN_LEFT: #see else suite
-        if alignment is ALIGN_CENTER:
-            padl = excess >> 1
-            padr = excess - padl
-        elif alignment is ALIGN_RIGHT:
-            padl = excess
-            padr = 0
-        else: #ALIGN_LEFT or unknown
-            padl = 0
-            padr = excess
-        screen.cbuf[x0 : x1, r] = padchar * padl + line + padchar * padr
-        screen.crow = r
-        screen.ccol = x1 - padr
+    for row in rows:
+        if screen.cbuf[x0 : x1, r].tostring() != row:
+            screen.cbuf[x0 : x1, r] = row
         r += 1
-        if r >= y1:
-            break
-        b0 = b1
+    if len(rows) > 0:
+        screen.crow = y0 + len(rows) - 1
+        screen.ccol = x0 + ccol
     screen.refresh((spanc, spanr))
 
 
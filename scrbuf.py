@@ -6,12 +6,22 @@ and character graphics
 import array, ctypes, itertools, zlib
 
 import sdl2
+try:
+    import numpy
+except ImportError:
+    numpy = None
+
+
+#translation table used to make shadow cells differ from the buffer
+_INVERT = ''.join(chr(c ^ 255) for c in xrange(256))
+#above this many damage rectangles, present the whole surface instead
+MAXRECTS = 32
 
 
 class ScrBuf(object):
 
     def __init__(self, scrsurf, charsurf, cellwidth, cellheight,
-                 refreshfn, rfnparams):
+                 refreshfn, rfnparams, rectrefreshfn=None, backend='blit'):
         self.NCOLS = 80
         self.NROWS = 25
         self.blankchar = 32
@@ -30,14 +40,112 @@ class ScrBuf(object):
             sdl2.SDL_SetSurfaceBlendMode(a, sdl2.SDL_BLENDMODE_NONE)
         self.refreshfn = refreshfn
         self.rfnparams = rfnparams
+        self.rectrefreshfn = rectrefreshfn
+        #in deferred present mode, refresh and present only note the areas
+        #and pixel rectangles to update (None for the whole surface), and
+        #flush draws and presents them all at once
+        self.deferpresent = False
+        self.pendingareas = []
+        self.pendingrects = []
+        #number of times anything has been copied to the window
+        self.presents = 0
+        #optional function given the set of (attribute, character) pairs
+        #about to be drawn, e.g. to render glyphs on demand
+        self.glyphfn = None
         self.cbuf = ByteBuf2D(self.NCOLS, self.NROWS, self.blankchar)
         self.catt = 7 if (len(self.charsurf) >= 8) else 0
         self.ccol = 0
         self.crow = 0
         self.abuf = ByteBuf2D(self.NCOLS, self.NROWS, self.catt)
+        #shadow copies of cbuf and abuf as last drawn to scrsurf
+        self.shadowc = ByteBuf2D(self.NCOLS, self.NROWS, self.blankchar)
+        self.shadowa = ByteBuf2D(self.NCOLS, self.NROWS, self.catt)
+        self.srcrect = sdl2.SDL_Rect()
+        self.dstrect = sdl2.SDL_Rect()
+        #the numpy backend composites whole frames from a glyph atlas, and
+        #needs a 32-bit xRGB screen surface; until an atlas is supplied it
+        #falls back to blitting
+        self.backend = 'blit'
+        self.atlas = None
+        self.attrpage = None
+        self.palettes = None
+        self.cellview = None
+        if backend == 'numpy' and numpy is not None:
+            fmt = getattr(self.scrsurf, 'contents', self.scrsurf) \
+                  .format.contents
+            if (fmt.BytesPerPixel, fmt.Rmask, fmt.Gmask, fmt.Bmask) \
+                   == (4, 0xff0000, 0xff00, 0xff):
+                self.backend = 'numpy'
+        self.invalidate()
         self.refresh()
         return
 
+    def areaspan(self, area=None):
+        #reduce an area (pair of ints, slices, or tuples of slice arguments)
+        #to its bounding cell span (c0, c1, r0, r1)
+        if area is None:
+            return (0, self.NCOLS, 0, self.NROWS)
+        rcols, rrows = area
+        if isinstance(rcols, tuple):
+            rcols = slice(*rcols).indices(self.NCOLS)
+        elif isinstance(rcols, slice):
+            rcols = rcols.indices(self.NCOLS)
+        else:
+            rcols = int(rcols)
+            rcols = (rcols, rcols + 1, 1)
+        if isinstance(rrows, tuple):
+            rrows = slice(*rrows).indices(self.NROWS)
+        elif isinstance(rrows, slice):
+            rrows = rrows.indices(self.NROWS)
+        else:
+            rrows = int(rrows)
+            rrows = (rrows, rrows + 1, 1)
+        rcols = xrange(*rcols)
+        rrows = xrange(*rrows)
+        if len(rcols) == 0 or len(rrows) == 0:
+            return (0, 0, 0, 0)
+        return (max(min(rcols[0], rcols[-1]), 0),
+                min(max(rcols[0], rcols[-1]) + 1, self.NCOLS),
+                max(min(rrows[0], rrows[-1]), 0),
+                min(max(rrows[0], rrows[-1]) + 1, self.NROWS))
+
+    def blitrects(self, rects):
+        #draw each cell in the given (c0, c1, r0, r1) rectangles with one
+        #SDL_BlitSurface call per cell
+        cw = self.cellwidth
+        ch = self.cellheight
+        srcrect = self.srcrect
+        dstrect = self.dstrect
+        srcrect.w = cw
+        srcrect.h = ch
+        charsurf = self.charsurf
+        scrsurf = self.scrsurf
+        blit = sdl2.SDL_BlitSurface
+        getslice = array.array.__getitem__
+        for c0, c1, r0, r1 in rects:
+            for r in xrange(r0, r1):
+                span = slice(r * self.NCOLS + c0, r * self.NCOLS + c1)
+                rowc = getslice(self.cbuf, span)
+                rowa = getslice(self.abuf, span)
+                dstrect.y = ch * r
+                for i in xrange(c1 - c0):
+                    srcrect.y = ch * rowc[i]
+                    dstrect.x = cw * (i + c0)
+                    blit(charsurf[rowa[i]], srcrect, scrsurf, dstrect)
+        return
+
+    def cellpairs(self, rects):
+        #return the set of (attribute, character) pairs shown in the given
+        #(c0, c1, r0, r1) rectangles
+        getslice = array.array.__getitem__
+        pairs = set()
+        for c0, c1, r0, r1 in rects:
+            for r in xrange(r0, r1):
+                span = slice(r * self.NCOLS + c0, r * self.NCOLS + c1)
+                pairs.update(itertools.izip(getslice(self.abuf, span),
+                                            getslice(self.cbuf, span)))
+        return pairs
+
     def cls(self):
         self.cbuf[:, :] = self.blankchar
         self.abuf[:, :] = self.catt
@@ -46,6 +154,30 @@ class ScrBuf(object):
         self.refresh()
         return
 
+    def compositerects(self, rects):
+        #draw the given (c0, c1, r0, r1) rectangles by gathering glyph
+        #pixels from the atlas straight into the screen surface
+        cb = numpy.frombuffer(self.cbuf, numpy.uint8).reshape(
+            self.NROWS, self.NCOLS)
+        ab = numpy.frombuffer(self.abuf, numpy.uint8).reshape(
+            self.NROWS, self.NCOLS)
+        sdl2.SDL_LockSurface(self.scrsurf)
+        try:
+            cells = self.surfacecells()
+            for c0, c1, r0, r1 in rects:
+                a = ab[r0 : r1, c0 : c1]
+                c = cb[r0 : r1, c0 : c1]
+                if self.palettes is None:
+                    pixels = self.atlas[self.attrpage[a], c]
+                else:
+                    pixels = self.palettes.ravel().take(
+                        (a.astype(numpy.intp) << 8)[:, :, None, None]
+                        | self.atlas[c])
+                cells[r0 : r1, :, c0 : c1, :] = pixels.transpose(0, 2, 1, 3)
+        finally:
+            sdl2.SDL_UnlockSurface(self.scrsurf)
+        return
+
     def cursorDown(self):
         self.crow += 1
         if self.crow >= self.NROWS:
@@ -97,6 +229,81 @@ class ScrBuf(object):
             self.crow = 0
         return
 
+    def damagerects(self, c0, c1, r0, r1):
+        #compare the span with the shadow buffers, bring the shadow up to
+        #date, and return the changed cells as (c0, c1, r0, r1) rectangles,
+        #merging runs which span the same columns on consecutive rows
+        getslice = array.array.__getitem__
+        setslice = array.array.__setitem__
+        rects = []
+        openrects = {}
+        for r in xrange(r0, r1):
+            span = slice(r * self.NCOLS + c0, r * self.NCOLS + c1)
+            newc = getslice(self.cbuf, span)
+            newa = getslice(self.abuf, span)
+            oldc = getslice(self.shadowc, span)
+            olda = getslice(self.shadowa, span)
+            runs = []
+            if newc != oldc or newa != olda:
+                setslice(self.shadowc, span, newc)
+                setslice(self.shadowa, span, newa)
+                runstart = None
+                for i in xrange(c1 - c0):
+                    if newc[i] == oldc[i] and newa[i] == olda[i]:
+                        if runstart is not None:
+                            runs.append((runstart + c0, i + c0))
+                            runstart = None
+                    elif runstart is None:
+                        runstart = i
+                if runstart is not None:
+                    runs.append((runstart + c0, c1))
+            nextopen = {}
+            for run in runs:
+                nextopen[run] = openrects.pop(run, r)
+            for run in openrects:
+                rects.append((run[0], run[1], openrects[run], r))
+            openrects = nextopen
+        for run in openrects:
+            rects.append((run[0], run[1], openrects[run], r1))
+        return rects
+
+    def draw(self, area=None):
+        #redraw changed cells in area on the screen surface without
+        #presenting, returning the damaged (x, y, w, h) pixel rectangles
+        c0, c1, r0, r1 = self.areaspan(area)
+        if c0 >= c1:
+            return []
+        rects = self.damagerects(c0, c1, r0, r1)
+        if self.glyphfn is not None and len(rects) > 0:
+            self.glyphfn(self.cellpairs(rects))
+        if self.backend == 'numpy' and self.atlas is not None:
+            self.compositerects(rects)
+        else:
+            self.blitrects(rects)
+        cw = self.cellwidth
+        ch = self.cellheight
+        return [(cw * x0, ch * y0, cw * (x1 - x0), ch * (y1 - y0))
+                for x0, x1, y0, y1 in rects]
+
+    def flush(self):
+        #draw and present everything refreshed or presented since the last
+        #flush, even in deferred present mode
+        areas = self.pendingareas
+        rects = self.pendingrects
+        self.pendingareas = []
+        self.pendingrects = []
+        for area in areas:
+            damage = self.draw(area)
+            if rects is not None:
+                rects.extend(damage)
+        self.uploadrects(rects)
+        return
+
+    def framebytes(self):
+        #return the screen surface pixels as drawn so far, row by row
+        surf = getattr(self.scrsurf, 'contents', self.scrsurf)
+        return ctypes.string_at(surf.pixels, surf.pitch * surf.h)
+
     def getColor(self, pos=None):
         if pos is None:
             return self.catt
@@ -112,10 +319,44 @@ class ScrBuf(object):
             rrows = slice(rrows, rrows + 1)
         rcols = rcols.indices(self.NCOLS)
         rrows = rrows.indices(self.NROWS)
+        if rcols[2] == 1 and rrows[2] == 1:
+            return '\n'.join(
+                [str(b) for b in self.cbuf.view(slice(*rcols),
+                                                slice(*rrows)).rows()])
         return '\n'.join(
             [self.cbuf[slice(*rcols), r].tostring()
              for r in xrange(*rrows)])
 
+    def invalidate(self, area=None):
+        #forget what was last drawn in area, so the next refresh redraws
+        #every cell there (e.g. after the character surfaces have changed)
+        c0, c1, r0, r1 = self.areaspan(area)
+        if c0 >= c1:
+            return
+        for r in xrange(r0, r1):
+            span = slice(r * self.NCOLS + c0, r * self.NCOLS + c1)
+            array.array.__setitem__(
+                self.shadowc, span, array.array('B',
+                    array.array.__getitem__(self.cbuf, span)
+                    .tostring().translate(_INVERT)))
+        return
+
+    def needsflush(self):
+        #whether deferred refreshes or presents are waiting for flush
+        return self.pendingrects is None or len(self.pendingrects) > 0 \
+               or len(self.pendingareas) > 0
+
+    def present(self, rects=None):
+        #copy the whole screen surface, or only the listed (x, y, w, h)
+        #pixel rectangles, to the window without redrawing anything
+        if not self.deferpresent:
+            self.uploadrects(rects)
+        elif rects is None:
+            self.pendingrects = None
+        elif self.pendingrects is not None:
+            self.pendingrects.extend(rects)
+        return
+
     def printChar(self, c, refresh=True):
         scrolled = False
         if self.ccol >= self.NCOLS:
@@ -208,56 +449,61 @@ class ScrBuf(object):
                       slice(minrow, maxrow + 1)))
 
     def refresh(self, area=None):
-        if area is None:
-            area = ((0, self.NCOLS, 1),
-                    (0, self.NROWS, 1))
-        rcols, rrows = area
-        if isinstance(rcols, tuple):
-            rcols = slice(*rcols).indices(self.NCOLS)
-        elif isinstance(rcols, slice):
-            rcols = rcols.indices(self.NCOLS)
-        else:
-            rcols = int(rcols)
-            rcols = (rcols, rcols + 1, 1)
-        if isinstance(rrows, tuple):
-            rrows = slice(*rrows).indices(self.NROWS)
-        elif isinstance(rrows, slice):
-            rrows = rrows.indices(self.NROWS)
-        else:
-            rrows = int(rrows)
-            rrows = (rrows, rrows + 1, 1)
-        rrows = xrange(*rrows)
-        rcols = range(*rcols)
-        for r in rrows:
-            y = r * self.cellheight
-            for c in rcols:
-                x = c * self.cellwidth
-                sdl2.SDL_BlitSurface(
-                    self.charsurf[self.abuf[c, r]],
-                    sdl2.SDL_Rect(
-                        0,
-                        self.cellheight * self.cbuf[c, r],
-                        self.cellwidth,
-                        self.cellheight),
-                    self.scrsurf,
-                    sdl2.SDL_Rect(
-                        self.cellwidth * c,
-                        self.cellheight * r,
-                        0, 0))
-        self.refreshfn(*self.rfnparams)
+        #redraw only those cells in area whose character or attribute
+        #differs from what was last drawn, then present the damaged part
+        if not self.deferpresent:
+            self.present(self.draw(area))
+        elif area is None:
+            self.pendingareas = [None]
+        elif self.pendingareas != [None]:
+            self.pendingareas.append(area)
         return
 
     def scroll(self, n):
-        if n >= self.NROWS:
+        #scroll the screen up by n rows (down if n is negative)
+        if n == 0:
+            return
+        if abs(n) >= self.NROWS:
             self.cls()
             return
-        nn = self.NROWS - n
-        self.cbuf[:, :nn] = self.cbuf[:, n:]
-        self.abuf[:, :nn] = self.abuf[:, n:]
-        self.cbuf[:, nn:] = self.blankchar
-        self.abuf[:, nn:] = self.catt
+        shift = abs(n) * self.NCOLS
+        size = self.NCOLS * self.NROWS
+        if n > 0:
+            keep = slice(0, size - shift)
+            moved = slice(shift, size)
+            exposed = slice(size - shift, size)
+        else:
+            keep = slice(shift, size)
+            moved = slice(0, size - shift)
+            exposed = slice(0, shift)
+        #shift the shadow buffers along with the rendered pixels, so that
+        #only the newly exposed rows differ from what is on the surface
+        getslice = array.array.__getitem__
+        setslice = array.array.__setitem__
+        for buf in (self.cbuf, self.abuf, self.shadowc, self.shadowa):
+            setslice(buf, keep, getslice(buf, moved))
+        setslice(self.cbuf, exposed,
+                 array.array('B', [self.blankchar]) * shift)
+        setslice(self.abuf, exposed,
+                 array.array('B', [self.catt]) * shift)
+        self.shiftpixels(n)
         self.crow -= n
-        self.refresh()
+        self.draw()
+        self.present()
+        return
+
+    def setatlas(self, atlas, attrpage=None, palettes=None):
+        #give the numpy backend its glyph pixels: atlas is a uint32 array
+        #of shape (pages, 256, cellheight, cellwidth) and attrpage maps
+        #each of the 256 attributes to a page of the atlas; or, given
+        #palettes, a uint32 array of shape (256, 256) holding the colors
+        #of each attribute, atlas is a uint8 array of shape (256,
+        #cellheight, cellwidth) indexing them
+        self.atlas = atlas
+        self.attrpage = None
+        if attrpage is not None:
+            self.attrpage = numpy.asarray(attrpage, numpy.intp)
+        self.palettes = palettes
         return
 
     def setColor(self, a, pos=None):
@@ -265,7 +511,59 @@ class ScrBuf(object):
             self.catt = a
             return
         self.abuf[pos] = a
-        self.refreshfn[pos]
+        self.refresh(pos)
+        return
+
+    def shiftpixels(self, n):
+        #move the rendered rows of the screen surface up by n text rows
+        #(down if n is negative) with a single memmove
+        surf = getattr(self.scrsurf, 'contents', self.scrsurf)
+        rowbytes = surf.pitch * self.cellheight
+        nbytes = rowbytes * (min(self.NROWS, surf.h // self.cellheight)
+                             - abs(n))
+        if nbytes <= 0:
+            return
+        sdl2.SDL_LockSurface(self.scrsurf)
+        try:
+            if n > 0:
+                ctypes.memmove(surf.pixels, surf.pixels + rowbytes * n, nbytes)
+            else:
+                ctypes.memmove(surf.pixels - rowbytes * n, surf.pixels, nbytes)
+        finally:
+            sdl2.SDL_UnlockSurface(self.scrsurf)
+        return
+
+    def surfacecells(self):
+        #return a (rows, cellheight, cols, cellwidth) numpy view of the
+        #screen surface pixels
+        surf = getattr(self.scrsurf, 'contents', self.scrsurf)
+        key = (surf.pixels, surf.pitch, self.cellwidth, self.cellheight)
+        if self.cellview is None or self.cellview[0] != key:
+            pixels = numpy.ctypeslib.as_array(
+                (ctypes.c_uint32 * (surf.pitch * surf.h >> 2))
+                .from_address(surf.pixels))
+            cells = numpy.lib.stride_tricks.as_strided(
+                pixels,
+                shape=(min(self.NROWS, surf.h // self.cellheight),
+                       self.cellheight,
+                       min(self.NCOLS, surf.w // self.cellwidth),
+                       self.cellwidth),
+                strides=(surf.pitch * self.cellheight,
+                         surf.pitch,
+                         self.cellwidth << 2,
+                         4))
+            self.cellview = (key, cells)
+        return self.cellview[1]
+
+    def uploadrects(self, rects):
+        #copy the listed pixel rectangles, or the whole surface if rects is
+        #None, from the screen surface to the window now
+        self.presents += 1
+        if rects is None or self.rectrefreshfn is None \
+               or len(rects) > MAXRECTS:
+            self.refreshfn(*self.rfnparams)
+        elif len(rects) > 0:
+            self.rectrefreshfn(rects)
         return
 
 
@@ -291,25 +589,15 @@ class ByteBuf2D(array.array):
             if rkey < 0:
                 rkey += self.nrows
             return array.array.__getitem__(self, ckey + self.ncols * rkey)
-        if isinstance(ckey, int):
-            if ckey < 0:
-                ckey += self.ncols
-            ckey = slice(ckey, ckey + 1)
-        cki = ckey.indices(self.ncols)
-        cn = len(xrange(*cki))
-        if isinstance(rkey, int):
-            if rkey < -1:
-                rkey += self.nrows
-            rkey = slice(rkey, rkey + 1)
-        rki = rkey.indices(self.nrows)
-        rn = len(xrange(*rki))
+        cn, rn, spans = self.spans(ckey, rkey)
         gather = ByteBuf2D(cn, rn)
-        dr = 0
-        for sr in xrange(*rki):
-            offset = sr * self.ncols
-            gather[:, dr] = array.array.__getitem__(
-                self, slice(cki[0] + offset, cki[1] + offset, cki[2]))
-            dr += 1
+        getslice = array.array.__getitem__
+        setslice = array.array.__setitem__
+        d = 0
+        for start, step, n in spans:
+            setslice(gather, slice(d, d + n),
+                     getslice(self, _stepslice(start, step, n)))
+            d += n
         return gather
 
     def __setitem__(self, key, value):
@@ -336,36 +624,18 @@ class ByteBuf2D(array.array):
             elif isinstance(value, unicode):
                 value = ord(value) & 255
             return array.array.__setitem__(self, ckey + self.ncols * rkey, value)
-        try:
-            src = iter(value)
-        except TypeError:
-            src = itertools.repeat(value)
-        if isinstance(ckey, int):
-            if ckey < 0:
-                ckey += self.ncols
-            ckey = slice(ckey, ckey + 1)
-        cki = ckey.indices(self.ncols)
-        cn = len(xrange(*cki))
-        if isinstance(rkey, int):
-            if rkey < -1:
-                rkey += self.nrows
-            rkey = slice(rkey, rkey + 1)
-        rki = rkey.indices(self.nrows)
-        rn = len(xrange(*rki))
-        for dr in xrange(*rki):
-            offset = dr * self.ncols
-            for dc in xrange(*cki):
-                try:
-                    c = next(src)
-                except StopIteration:
+        cn, rn, spans = self.spans(ckey, rkey)
+        src = _bytearray(value, cn * rn)
+        srclen = array.array.__len__(src)
+        setslice = array.array.__setitem__
+        s = 0
+        for start, step, n in spans:
+            if s + n > srclen:
+                n = srclen - s
+                if n <= 0:
                     return
-                if isinstance(c, float):
-                    c = int(c) & 255
-                elif isinstance(c, str):
-                    c = ord(c)
-                elif isinstance(c, unicode):
-                    c = ord(c) & 255
-                array.array.__setitem__(self, dc + offset, c)
+            setslice(self, _stepslice(start, step, n), src[s : s + n])
+            s += n
 
     def __iter__(self):
         self.iteridx = 0
@@ -392,6 +662,158 @@ class ByteBuf2D(array.array):
                 for c in xrange(self.ncols)]) + ']'
             for r in xrange(self.nrows)]) + ']'
 
+    def blit(self, src, pos=(0, 0)):
+        #copy all of src (a ByteBuf2D or ByteView2D) into this buffer with
+        #its top left corner at cell pos, clipping at the edges
+        if isinstance(src, ByteView2D):
+            base, bc, br = src.base, src.c0, src.r0
+        else:
+            base, bc, br = src, 0, 0
+        c, r = pos
+        sc = max(0, -c)
+        sr = max(0, -r)
+        w = min(src.ncols, self.ncols - c) - sc
+        h = min(src.nrows, self.nrows - r) - sr
+        if w <= 0 or h <= 0:
+            return
+        getslice = array.array.__getitem__
+        setslice = array.array.__setitem__
+        rows = xrange(h)
+        if base is self and r > br:
+            rows = reversed(rows)
+        for i in rows:
+            so = (br + sr + i) * base.ncols + bc + sc
+            do = (r + sr + i) * self.ncols + c + sc
+            setslice(self, slice(do, do + w),
+                     getslice(base, slice(so, so + w)))
+        return
+
+    def spans(self, ckey, rkey):
+        #return the selection's width and height, and a list of the
+        #(start, step, count) runs of flat indices it covers, in row order
+        cki = _keyindices(ckey, self.ncols)
+        rki = _keyindices(rkey, self.nrows)
+        cn = len(xrange(*cki))
+        rows = xrange(*rki)
+        if cn == 0:
+            return (0, len(rows), [])
+        if cki[2] == 1 and cn == self.ncols and rki[2] == 1:
+            #whole rows are contiguous in memory
+            return (cn, len(rows),
+                    [(rki[0] * self.ncols, 1, cn * len(rows))] if rows else [])
+        return (cn, len(rows),
+                [(cki[0] + r * self.ncols, cki[2], cn) for r in rows])
+
+    def view(self, ckey=None, rkey=None):
+        return ByteView2D(self, ckey, rkey)
+
+
+class ByteView2D(object):
+    '''
+    Read-only rectangular window onto a ByteBuf2D. Rows are read through
+    buffer objects sharing the ByteBuf2D's memory, so nothing is copied until
+    asked for, and later changes to the ByteBuf2D show through the view.
+    '''
+
+    def __init__(self, base, ckey=None, rkey=None):
+        cki = _keyindices(ckey, base.ncols)
+        rki = _keyindices(rkey, base.nrows)
+        if cki[2] != 1 or rki[2] != 1:
+            raise ValueError('ByteView2D area must be contiguous')
+        self.base = base
+        self.c0 = cki[0]
+        self.r0 = rki[0]
+        self.ncols = max(cki[1] - cki[0], 0)
+        self.nrows = max(rki[1] - rki[0], 0)
+
+    def __getitem__(self, key):
+        if not isinstance(key, tuple) or len(key) != 2:
+            raise TypeError('2D view index must be tuple of length 2')
+        ckey, rkey = key
+        if isinstance(ckey, int) and isinstance(rkey, int):
+            if ckey < 0:
+                ckey += self.ncols
+            if rkey < 0:
+                rkey += self.nrows
+            if not (0 <= ckey < self.ncols and 0 <= rkey < self.nrows):
+                raise IndexError('2D view index out of range')
+            return self.base[self.c0 + ckey, self.r0 + rkey]
+        return self.copy()[key]
+
+    def __repr__(self):
+        return '<ByteView2D {:d}x{:d} at ({:d}, {:d})>'.format(
+            self.ncols, self.nrows, self.c0, self.r0)
+
+    def copy(self):
+        gather = ByteBuf2D(self.ncols, self.nrows)
+        gather.blit(self)
+        return gather
+
+    def row(self, r):
+        if r < 0:
+            r += self.nrows
+        if not 0 <= r < self.nrows:
+            raise IndexError('2D view row out of range')
+        return buffer(self.base,
+                      (self.r0 + r) * self.base.ncols + self.c0,
+                      self.ncols)
+
+    def rows(self):
+        return [self.row(r) for r in xrange(self.nrows)]
+
+    def tostring(self):
+        return ''.join(str(b) for b in self.rows())
+
+
+def _bytearray(value, count):
+    #convert anything ByteBuf2D.__setitem__ accepts into an array of at
+    #most count bytes; scalars are broadcast to fill all count bytes
+    if isinstance(value, array.array) and value.typecode == 'B':
+        return value
+    if isinstance(value, ByteView2D):
+        value = value.tostring()
+    if isinstance(value, (str, bytearray, buffer)):
+        return array.array('B', str(value[: count]))
+    if isinstance(value, unicode):
+        return array.array('B', [ord(c) & 255 for c in value[: count]])
+    if isinstance(value, float):
+        return array.array('B', [int(value) & 255]) * count
+    try:
+        src = list(itertools.islice(value, count))
+    except TypeError:
+        return array.array('B', [value]) * count
+    try:
+        return array.array('B', src)
+    except TypeError:
+        pass
+    for i in xrange(len(src)):
+        c = src[i]
+        if isinstance(c, float):
+            src[i] = int(c) & 255
+        elif isinstance(c, str):
+            src[i] = ord(c)
+        elif isinstance(c, unicode):
+            src[i] = ord(c) & 255
+    return array.array('B', src)
+
+
+def _keyindices(key, n):
+    #like slice.indices, but also accepting None and int keys
+    if key is None:
+        return (0, n, 1)
+    if isinstance(key, slice):
+        return key.indices(n)
+    key = int(key)
+    if key < 0:
+        key += n
+    return (key, key + 1, 1)
+
+
+def _stepslice(start, step, n):
+    #slice covering n items from start in steps of step
+    stop = start + step * n
+    return slice(start, stop if stop >= 0 else None, step)
+
 
 def defaultfont(forergb, backrgb, cwidth=8, cheight=16):
     '''
@@ -401,7 +823,7 @@ def defaultfont(forergb, backrgb, cwidth=8, cheight=16):
     Return a pointer to this SDL_Surface and a data array which must not be
     freed until the surface is freed.
     '''
-    pixdata = (ctypes.c_ulong * int(1024 * cwidth * cheight))()
+    pixdata = (ctypes.c_uint32 * int(256 * cwidth * cheight))()
     charset = sdl2.SDL_CreateRGBSurfaceFrom(ctypes.byref(pixdata),
                                             cwidth, cheight << 8,
                                             32,
@@ -435,6 +857,50 @@ def defaultfont(forergb, backrgb, cwidth=8, cheight=16):
     return charset, pixdata
 
 
+def headless(charsurf, cellwidth, cellheight, backend='blit', frames=None):
+    '''
+    Return a ScrBuf drawing to an offscreen 32-bit xRGB SDL_Surface, for
+    running and timing the screen without a window. Presenting does
+    nothing but count in the ScrBuf's presents, and, if frames is a list,
+    append a copy of the surface pixels to it. The caller frees the
+    surface (the ScrBuf's scrsurf) with SDL_FreeSurface.
+    '''
+    scrsurf = sdl2.SDL_CreateRGBSurface(0,
+                                        80 * cellwidth, 25 * cellheight,
+                                        32,
+                                        0xff0000,
+                                        0xff00,
+                                        0xff,
+                                        0x0)
+    if not scrsurf:
+        raise RuntimeError(sdl2.SDL_GetError())
+    screen = []
+    def present(rects=None):
+        if frames is not None and len(screen) > 0:
+            frames.append(screen[0].framebytes())
+    screen.append(ScrBuf(scrsurf,
+                         charsurf,
+                         cellwidth, cellheight,
+                         present,
+                         (),
+                         present,
+                         backend))
+    return screen[0]
+
+
+def rectrefresher(window):
+    '''
+    Given a SDL_Window, return a function which takes a list of (x, y, w, h)
+    pixel rectangles and copies just those areas of the window surface to
+    the screen.
+    '''
+    def refreshrects(rects):
+        n = len(rects)
+        rectarray = (sdl2.SDL_Rect * n)(*[sdl2.SDL_Rect(*r) for r in rects])
+        sdl2.SDL_UpdateWindowSurfaceRects(window, rectarray, n)
+    return refreshrects
+
+
 if __name__ == '__main__':
     import ctypes, sys, time, zlib
     print 'Initializing SDL...'
@@ -471,7 +937,8 @@ if __name__ == '__main__':
                           charsets,
                           8, 16,
                           sdl2.SDL_UpdateWindowSurface,
-                          (window,)
+                          (window,),
+                          rectrefresher(window)
                           )
     print 'Writing to screen buffer...'
     screenbuffer.cbuf[:, :] = [32] * 2000
@@ -0,0 +1,500 @@
+'''
+Tests for document.py, run with: python -m unittest test_document
+'''
+
+import os, random, shutil, stat, tempfile, unittest
+
+import document
+
+
+class DocumentTest(unittest.TestCase):
+
+    def setUp(self):
+        self.tempdir = tempfile.mkdtemp(prefix='g-she-test')
+        self.docs = []
+        self.rand = random.Random(2019)
+
+    def tearDown(self):
+        for doc in self.docs:
+            doc.close()
+        shutil.rmtree(self.tempdir, True)
+
+    def makedoc(self, data, writable=True, undomemory=4 << 20,
+                name='doc.bin'):
+        #a document opened on a new file holding data
+        filename = os.path.join(self.tempdir, name)
+        with open(filename, 'wb') as f:
+            f.write(data)
+        doc = document.Document(filename, writable, undomemory)
+        self.docs.append(doc)
+        return doc
+
+    def randomedit(self, doc, model):
+        #make a random insert, delete or replace in doc and the bytearray
+        #model alike
+        rand = self.rand
+        offset = rand.randrange(len(model) + 1)
+        op = rand.random()
+        if op < 0.4 or len(model) == 0:
+            data = os.urandom(rand.randint(1, 20))
+            doc.insert(offset, data)
+            model[offset : offset] = data
+        elif op < 0.7:
+            n = min(rand.randint(1, 30), len(model) - offset)
+            doc.delete(offset, n)
+            del model[offset : offset + n]
+        else:
+            n = min(rand.randint(0, 10), len(model) - offset)
+            data = os.urandom(rand.randint(0, 10))
+            doc.replace(offset, n, data)
+            model[offset : offset + n] = data
+
+    def assertHistory(self, doc, states):
+        #undo back through states, the contents after each edit from the
+        #first, then redo forward through them again
+        for state in reversed(states[: -1]):
+            self.assertIsNotNone(doc.undo())
+            self.assertEqual(doc[:], state)
+        self.assertIsNone(doc.undo())
+        for state in states[1 :]:
+            self.assertIsNotNone(doc.redo())
+            self.assertEqual(doc[:], state)
+        self.assertIsNone(doc.redo())
+
+    def assertSaved(self, doc):
+        #the document's file holds exactly its content
+        with open(doc.filename, 'rb') as f:
+            self.assertEqual(f.read(), doc[:])
+
+    def assertContent(self, doc, model):
+        self.assertEqual(len(doc), len(model))
+        self.assertEqual(doc.read(0, len(doc)), str(model))
+
+
+class EditTest(DocumentTest):
+
+    def test_open(self):
+        doc = self.makedoc('0123456789', False)
+        self.assertEqual(len(doc), 10)
+        self.assertEqual(doc[3], ord('3'))
+        self.assertEqual(doc[-1], ord('9'))
+        self.assertEqual(doc[2 : 5], '234')
+        self.assertEqual(doc.read(8, 10), '89')
+        self.assertRaises(IndexError, doc.__getitem__, 10)
+        self.assertRaises(TypeError, doc.insert, 0, 'x')
+
+    def test_empty(self):
+        doc = self.makedoc('')
+        self.assertEqual(len(doc), 0)
+        self.assertEqual(doc.read(0, 10), '')
+        doc.insert(0, 'abc')
+        self.assertEqual(doc[:], 'abc')
+
+    def test_model(self):
+        model = bytearray(os.urandom(5000))
+        doc = self.makedoc(str(model))
+        for i in xrange(2000):
+            self.randomedit(doc, model)
+            if i % 100 == 0:
+                self.assertContent(doc, model)
+                offset = self.rand.randrange(len(model) + 1)
+                self.assertEqual(doc.read(offset, 300),
+                                 str(model[offset : offset + 300]))
+        self.assertContent(doc, model)
+        self.assertEqual(sum(n for docoffset, buf, start, n
+                             in doc.pieces()), len(model))
+
+    def test_setitem(self):
+        model = bytearray('0123456789')
+        doc = self.makedoc(str(model))
+        doc[4] = 0x41
+        doc[-1] = 0x42
+        doc[1 : 3] = 'xy'
+        model[4] = 0x41
+        model[-1] = 0x42
+        model[1 : 3] = 'xy'
+        self.assertContent(doc, model)
+        self.assertRaises(ValueError, doc.__setitem__, slice(0, 2), 'abc')
+        self.assertRaises(IndexError, doc.delete, 8, 5)
+
+
+class JournalTest(DocumentTest):
+
+    def test_rewrite_after_other_edit(self):
+        #rewriting an inserted byte once another edit has been recorded
+        #must not change the insertion's record in place
+        doc = self.makedoc('0123456789ABCDEFGHIJ')
+        states = [doc[:]]
+        doc.insert(2, 'a')
+        states.append(doc[:])
+        doc.delete(10, 1)
+        states.append(doc[:])
+        doc[2] = ord('b')
+        states.append(doc[:])
+        self.assertEqual(states[-1], '01b2345678ABCDEFGHIJ')
+        self.assertHistory(doc, states)
+
+    def test_typing_after_paste(self):
+        #a byte typed just after a paste, or over its last byte, is undone
+        #on its own, not together with the paste
+        for overwrite in (False, True):
+            doc = self.makedoc('0123456789')
+            states = [doc[:]]
+            doc.insert(4, 'abcdef')
+            states.append(doc[:])
+            if overwrite:
+                doc[9] = ord('x')
+            else:
+                doc.insert(10, 'x')
+            states.append(doc[:])
+            self.assertEqual(len(doc.journal.undos), 2)
+            self.assertHistory(doc, states)
+
+    def test_typing(self):
+        #typing hex digits in overwrite mode coalesces into one record per
+        #run, rewriting the byte of each first digit in place
+        doc = self.makedoc('\x00' * 64)
+        states = [doc[:]]
+        for run in (0, 20, 40):
+            for i in xrange(run, run + 8):
+                doc[i] = 0x0a
+                doc[i] = 0xab
+            doc.journal.seal()
+            states.append(doc[:])
+        self.assertEqual(len(doc.journal.undos), 3)
+        self.assertEqual(len(doc.added), 24)
+        self.assertHistory(doc, states)
+
+    def test_coalesced_edits(self):
+        #single byte inserts, deletes and rewrites joining and breaking
+        #runs, undone and redone all the way
+        model = bytearray(os.urandom(200))
+        doc = self.makedoc(str(model))
+        states = [str(model)]
+        rand = self.rand
+        offset = 100
+        for i in xrange(400):
+            op = rand.random()
+            if op < 0.1:
+                offset = rand.randrange(len(model))
+                doc.journal.seal()
+            records = len(doc.journal.undos)
+            if op < 0.5:
+                doc.insert(offset, chr(rand.randrange(256)))
+                offset += 1
+            elif op < 0.7 and offset < len(model):
+                doc.delete(offset, 1)
+            elif offset > 0:
+                doc[offset - 1] = rand.randrange(256)
+            else:
+                continue
+            if len(doc.journal.undos) == records:
+                states[-1] = doc[:]
+            else:
+                states.append(doc[:])
+        self.assertLess(len(states), 200)
+        self.assertHistory(doc, states)
+
+    def test_random_history(self):
+        #random edits and random undos and redos against saved states
+        model = bytearray(os.urandom(1000))
+        doc = self.makedoc(str(model))
+        states = [str(model)]
+        position = 0
+        for i in xrange(600):
+            if self.rand.random() < 0.3 and position > 0:
+                doc.undo()
+                position -= 1
+            elif self.rand.random() < 0.3 and position < len(states) - 1:
+                doc.redo()
+                position += 1
+            else:
+                model = bytearray(states[position])
+                self.randomedit(doc, model)
+                doc.journal.seal()
+                del states[position + 1 :]
+                states.append(str(model))
+                position += 1
+            self.assertEqual(doc[:], states[position])
+
+    def test_spill(self):
+        #a small memory cap spills old records to the temporary file and
+        #reads them back when undoing that far
+        model = bytearray(os.urandom(2000))
+        doc = self.makedoc(str(model), undomemory=3000)
+        states = [str(model)]
+        for i in xrange(300):
+            self.randomedit(doc, model)
+            doc.journal.seal()
+            states.append(str(model))
+        self.assertGreater(len(doc.journal.undos.spilled), 0)
+        self.assertLessEqual(doc.journal.undos.memory, 1500 + 2000)
+        self.assertEqual(len(doc.journal.undos), 300)
+        self.assertHistory(doc, states)
+
+
+class SaveTest(DocumentTest):
+
+    def test_patch(self):
+        #same size edits write only the modified extents
+        model = bytearray(os.urandom(100000))
+        doc = self.makedoc(str(model))
+        states = [str(model)]
+        for offset in (10, 5000, 5001, 99999):
+            doc[offset] = model[offset] ^ 0xff
+            model[offset] ^= 0xff
+            doc.journal.seal()
+            states.append(str(model))
+        self.assertEqual(doc.modifiedExtents(),
+                         [(10, 1), (5000, 2), (99999, 1)])
+        self.assertEqual(doc.save(), 4)
+        self.assertSaved(doc)
+        self.assertEqual(len(list(doc.pieces())), 1)
+        self.assertEqual(doc.save(), 0)
+        #the journal still undoes to the bytes the file held before
+        doc.undo()
+        self.assertEqual(doc[:], states[-2])
+        self.assertEqual(doc.save(), 1)
+        self.assertSaved(doc)
+        while doc.undo() is not None:
+            pass
+        self.assertEqual(doc[:], states[0])
+        while doc.redo() is not None:
+            pass
+        self.assertEqual(doc[:], states[-1])
+
+    def test_moved_overlap(self):
+        #deleting in one place and inserting in another moves the file
+        #bytes between over part of where they came from; they must be
+        #saved from their old places, not from what the save wrote over
+        model = bytearray(''.join(chr(i) for i in xrange(256)) * 40)
+        doc = self.makedoc(str(model))
+        states = [str(model)]
+        doc.delete(1000, 300)
+        del model[1000 : 1300]
+        states.append(str(model))
+        doc.insert(5000, 'x' * 300)
+        model[5000 : 5000] = 'x' * 300
+        states.append(str(model))
+        self.assertTrue(any(buf == document.ORIGINAL and start != docoffset
+                            for docoffset, buf, start, n in doc.pieces()))
+        self.assertEqual(len(doc), doc.filesize)
+        doc.save()
+        self.assertSaved(doc)
+        self.assertEqual(doc[:], str(model))
+        doc.undo()
+        self.assertEqual(doc[:], states[1])
+        doc.undo()
+        self.assertEqual(doc[:], states[0])
+        doc.save()
+        self.assertSaved(doc)
+        doc.redo()
+        doc.redo()
+        self.assertEqual(doc[:], states[2])
+
+    def test_progress(self):
+        #progress is reported after each chunk of the modified extents,
+        #and cancelling puts back the bytes already written over
+        model = bytearray(os.urandom(3 << 20))
+        doc = self.makedoc(str(model))
+        states = [str(model)]
+        for offset, n in ((90, 10), (1000, (1 << 20) + 5),
+                          ((3 << 20) - 1, 1)):
+            data = os.urandom(n)
+            doc[offset : offset + n] = data
+            model[offset : offset + n] = data
+            doc.journal.seal()
+            states.append(str(model))
+        total = sum(length for offset, length in doc.modifiedExtents())
+        calls = []
+        def progress(done, total):
+            calls.append((done, total))
+            return len(calls) < 3
+        self.assertIsNone(doc.save(progress))
+        self.assertEqual(len(calls), 3)
+        with open(doc.filename, 'rb') as f:
+            self.assertEqual(f.read(), states[0])
+        self.assertEqual(doc[:], str(model))
+        #saving again once not cancelled
+        del calls[:]
+        self.assertEqual(doc.save(lambda done, total:
+                                  calls.append((done, total))), total)
+        self.assertEqual([done for done, n in calls],
+                         [10, 10 + (1 << 20), 15 + (1 << 20), 16 + (1 << 20)])
+        self.assertEqual(set(n for done, n in calls), set([total]))
+        self.assertSaved(doc)
+        self.assertHistory(doc, states)
+
+    def test_deferred_reopen(self):
+        #saving in place without reopening leaves the pieces and the
+        #journal alone until reopen() is called
+        model = bytearray(os.urandom(1000))
+        doc = self.makedoc(str(model))
+        states = [str(model)]
+        for offset in (10, 500):
+            doc[offset : offset + 4] = 'abcd'
+            model[offset : offset + 4] = 'abcd'
+            doc.journal.seal()
+            states.append(str(model))
+        added = len(doc.added)
+        self.assertEqual(doc.save(None, False), 8)
+        self.assertEqual(doc.pendingfile, doc.filename)
+        self.assertEqual(len(doc.added), added)
+        self.assertEqual(len(list(doc.pieces())), 5)
+        self.assertEqual(doc[:], str(model))
+        self.assertSaved(doc)
+        self.assertRaises(ValueError, doc.save)
+        doc.reopen()
+        self.assertIsNone(doc.pendingfile)
+        self.assertEqual(len(list(doc.pieces())), 1)
+        self.assertEqual(doc[:], str(model))
+        self.assertHistory(doc, states)
+
+    def test_random_same_size(self):
+        #random same size edits with saves between them, then the whole
+        #history undone and redone
+        model = bytearray(os.urandom(20000))
+        doc = self.makedoc(str(model), undomemory=8000)
+        states = [str(model)]
+        rand = self.rand
+        for i in xrange(200):
+            offset = rand.randrange(len(model) - 64)
+            n = rand.randint(1, 64)
+            if rand.random() < 0.5:
+                data = os.urandom(n)
+                doc[offset : offset + n] = data
+                model[offset : offset + n] = data
+            else:
+                target = rand.randrange(len(model) - n)
+                moved = model[offset : offset + n]
+                doc.delete(offset, n)
+                del model[offset : offset + n]
+                states.append(str(model))
+                doc.journal.seal()
+                doc.insert(target, str(moved))
+                model[target : target] = moved
+            doc.journal.seal()
+            states.append(str(model))
+            if i % 20 == 19:
+                doc.save()
+                self.assertSaved(doc)
+                self.assertEqual(doc[:], str(model))
+        self.assertHistory(doc, states)
+        doc.save()
+        self.assertSaved(doc)
+
+
+class SaveAsTest(DocumentTest):
+
+    def setUp(self):
+        DocumentTest.setUp(self)
+        self.copyfunctions = list(document.copyfunctions)
+
+    def tearDown(self):
+        document.copyfunctions[:] = self.copyfunctions
+        DocumentTest.tearDown(self)
+
+    def tempfiles(self):
+        return [name for name in os.listdir(self.tempdir)
+                if name.startswith('.g-she')]
+
+    def resized(self, size=300000):
+        #a document with random edits changing its size, the contents
+        #after each edit, and its model
+        model = bytearray(os.urandom(size))
+        doc = self.makedoc(str(model), undomemory=20000)
+        states = [str(model)]
+        for i in xrange(100):
+            self.randomedit(doc, model)
+            doc.journal.seal()
+            states.append(str(model))
+        doc.insert(0, 'grown')
+        model[0 : 0] = 'grown'
+        states.append(str(model))
+        return doc, states, model
+
+    def test_resized(self):
+        #each way of copying file bytes, down to buffered writes
+        for functions in (self.copyfunctions, self.copyfunctions[1 :], []):
+            document.copyfunctions[:] = functions
+            doc, states, model = self.resized()
+            os.chmod(doc.filename, 0640)
+            reports = []
+            written = doc.save(lambda done, total:
+                               reports.append((done, total)))
+            self.assertEqual(written, len(model))
+            self.assertSaved(doc)
+            self.assertEqual(doc.filesize, len(model))
+            self.assertEqual(len(list(doc.pieces())), 1)
+            self.assertEqual(reports[-1], (len(model), len(model)))
+            self.assertEqual(stat.S_IMODE(os.stat(doc.filename).st_mode),
+                             0640)
+            self.assertEqual(self.tempfiles(), [])
+            #the journal now reads the replaced file through its old
+            #mapping
+            self.assertEqual(len(doc.buffers), 3)
+            self.assertHistory(doc, states)
+            doc.close()
+            self.docs.remove(doc)
+
+    def test_cancel(self):
+        doc, states, model = self.resized(1 << 20)
+        with open(doc.filename, 'rb') as f:
+            before = f.read()
+        calls = []
+        def progress(done, total):
+            calls.append(done)
+            return len(calls) < 2
+        self.assertIsNone(doc.save(progress))
+        self.assertEqual(len(calls), 2)
+        with open(doc.filename, 'rb') as f:
+            self.assertEqual(f.read(), before)
+        self.assertEqual(self.tempfiles(), [])
+        self.assertEqual(doc[:], str(model))
+        self.assertNotEqual(doc.filesize, len(doc))
+        #saving again once not cancelled
+        self.assertEqual(doc.save(), len(model))
+        self.assertSaved(doc)
+        self.assertHistory(doc, states)
+
+    def test_deferred_reopen(self):
+        #saving without reopening leaves the document reading the old
+        #file until reopen() is called
+        doc, states, model = self.resized()
+        doc.save(None, False)
+        self.assertEqual(doc.pendingfile, doc.filename)
+        self.assertNotEqual(doc.filesize, len(doc))
+        self.assertEqual(doc[:], str(model))
+        self.assertSaved(doc)
+        doc.reopen()
+        self.assertIsNone(doc.pendingfile)
+        self.assertEqual(doc.filesize, len(doc))
+        self.assertEqual(len(list(doc.pieces())), 1)
+        self.assertEqual(doc[:], str(model))
+        self.assertHistory(doc, states)
+
+    def test_other_file(self):
+        doc, states, model = self.resized()
+        oldname = doc.filename
+        newname = os.path.join(self.tempdir, 'other.bin')
+        doc.saveAs(newname)
+        self.assertEqual(doc.filename, newname)
+        self.assertSaved(doc)
+        with open(oldname, 'rb') as f:
+            self.assertEqual(f.read(), states[0])
+        #edits and same size saves now go to the new file
+        doc[3] = 0x55
+        model[3] = 0x55
+        self.assertEqual(doc.save(), 1)
+        self.assertSaved(doc)
+        self.assertEqual(doc[:], str(model))
+
+    def test_reopen_mismatch(self):
+        doc = self.makedoc('0123456789')
+        doc.insert(0, 'x')
+        self.assertRaises(ValueError, doc.reopen, doc.filename)
+        self.assertEqual(doc[:], 'x0123456789')
+
+
+if __name__ == '__main__':
+    unittest.main()